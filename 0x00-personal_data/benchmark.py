@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmark suite of the redacting logger: filter_datum,
+RedactingFormatter.format and the row to message step of main(), over
+message sizes and redaction ratios. Results are written as JSON and can
+be compared against a stored baseline
+"""
+import argparse
+import json
+import logging
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from filtered_logger import (RedactingFormatter, filter_datum, row_template,
+                             scan_filter_datum)
+
+
+SIZES = (5, 20, 50, 200)
+RATIOS = (0.0, 0.25, 0.5, 0.75, 1.0)
+ITERATIONS = 2000
+# redacted at ratio 0: no field of the messages has this name, whereas an
+# empty field list would build a pattern matching every field
+ABSENT_FIELD = "absent"
+ALLOC_ITERATIONS = 200
+SEED = 2019
+THRESHOLD = 0.10
+
+
+def legacy_filter_datum(fields: List[str], redaction: str,
+                        message: str, separator: str) -> str:
+    """filter_datum as it was before the pattern cache (one compile
+    per call)"""
+    return re.sub(fr'({"|".join(fields)})=[^{separator}]+',
+                  f'\\1={redaction}', message)
+
+
+def legacy_row_message(row: tuple, fields: List[str]) -> str:
+    """Row to message step of main() before the precomputed template"""
+    return ''.join(f'{f}={str(val)}; ' for val, f in zip(row, fields)).strip()
+
+
+def make_case(size: int, ratio: float) -> Dict:
+    """
+    Build, from a fixed seed, a `size` fields message of which a `ratio`
+    share are PII fields, along with the matching row
+    """
+    rng = random.Random("{}-{}".format(SEED, size))
+    names = ["field{}".format(n) for n in range(size)]
+    values = ["".join(rng.choice("abcdefghij0123456789@.-")
+                      for _ in range(rng.randint(4, 24)))
+              for _ in range(size)]
+    pii = sorted(rng.sample(names, round(size * ratio)))
+    return {
+        "names": names,
+        "row": tuple(values),
+        "pii": pii,
+        "message": "".join("{}={};".format(n, v)
+                           for n, v in zip(names, values)),
+    }
+
+
+def measure(func: Callable, iterations: int) -> Dict:
+    """
+    Time `iterations` calls of `func` one by one, then trace the memory
+    allocated by the calls. Returns ops/sec, p50/p99 latency in
+    microseconds and the bytes allocated per call
+    """
+    func()
+    clock = time.perf_counter_ns
+    timings = []
+    for _ in range(iterations):
+        start = clock()
+        func()
+        timings.append(clock() - start)
+    timings.sort()
+
+    tracemalloc.start()
+    allocated = 0
+    for _ in range(ALLOC_ITERATIONS):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return {
+        "ops_per_sec": round(1e9 * iterations / sum(timings), 1),
+        "p50_us": round(timings[len(timings) // 2] / 1000, 3),
+        "p99_us": round(timings[int(len(timings) * 0.99)] / 1000, 3),
+        "alloc_bytes_per_call": allocated // ALLOC_ITERATIONS,
+    }
+
+
+def benchmarks(size: int, ratio: float) -> Dict[str, Callable]:
+    """Return the callables to measure for one size and ratio"""
+    case = make_case(size, ratio)
+    pii, message = case["pii"] or [ABSENT_FIELD], case["message"]
+    record = logging.LogRecord("user_data", logging.INFO, None, None,
+                               message, None, None)
+    regex = RedactingFormatter(pii)
+    scan = RedactingFormatter(pii, engine="scan")
+    funcs = {
+        "filter_datum": lambda: filter_datum(pii, "***", message, ";"),
+        "filter_datum_uncached":
+            lambda: legacy_filter_datum(pii, "***", message, ";"),
+        "scan_filter_datum":
+            lambda: scan_filter_datum(pii, "***", message, ";"),
+        "format_regex": lambda: regex.format(record),
+        "format_scan": lambda: scan.format(record),
+    }
+    if ratio == RATIOS[0]:
+        names, row = case["names"], case["row"]
+        template = row_template(names)
+        funcs.update({
+            "row_message_legacy": lambda: legacy_row_message(row, names),
+            "row_message_template": lambda: template % row,
+        })
+    return funcs
+
+
+def run(iterations: int) -> Dict:
+    """Run the whole suite, printing one line per measurement"""
+    results = []
+    for size in SIZES:
+        for ratio in RATIOS:
+            for name, func in benchmarks(size, ratio).items():
+                result = {"benchmark": name, "fields": size, "ratio": ratio}
+                result.update(measure(func, iterations))
+                results.append(result)
+                print("{benchmark:<22}{fields:>5}{ratio:>6.2f}"
+                      "{ops_per_sec:>14,.0f}{p50_us:>10.2f}{p99_us:>10.2f}"
+                      "{alloc_bytes_per_call:>10}".format(**result))
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "iterations": iterations,
+        "results": results,
+    }
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> int:
+    """
+    Print the ops/sec change of every measurement against `baseline` and
+    return the number of them slower by more than `threshold`
+    """
+    def key(result):
+        """Identify a measurement across runs"""
+        return result["benchmark"], result["fields"], result["ratio"]
+
+    previous = {key(r): r for r in baseline["results"]}
+    regressions = 0
+    for result in current["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        change = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        flag = ""
+        if change < -threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print("{:<22}{:>5}{:>6.2f}{:>+9.1%}{}".format(
+            result["benchmark"], result["fields"], result["ratio"],
+            change, flag))
+    return regressions
+
+
+def main():
+    """
+    Run the suite, write the JSON results and compare them to a baseline
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-o", "--output", default="benchmark_results.json",
+                        help="where to write the JSON results")
+    parser.add_argument("-b", "--baseline",
+                        help="JSON results to compare against")
+    parser.add_argument("-n", "--iterations", type=int, default=ITERATIONS,
+                        help="timed calls per measurement")
+    parser.add_argument("-t", "--threshold", type=float, default=THRESHOLD,
+                        help="ops/sec drop reported as a regression")
+    args = parser.parse_args()
+
+    print("{:<22}{:>5}{:>6}{:>14}{:>10}{:>10}{:>10}".format(
+        "benchmark", "size", "ratio", "ops/sec", "p50 us", "p99 us",
+        "bytes"))
+    current = run(args.iterations)
+    with open(args.output, "w") as f:
+        json.dump(current, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\nchange against {}".format(args.baseline))
+        if compare(current, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,22 @@
 """
 script to hash a given password
 """
+import asyncio
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Tuple
 import bcrypt
 
 
+MAX_WORKERS = int(os.getenv("PERSONAL_DATA_HASH_WORKERS",
+                            os.cpu_count() or 1))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
 def hash_password(password: str) -> bytes:
     """
     Generates random salt and hash the password
@@ -21,3 +34,66 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
     validate that the provided password matches the hashed password
     """
     return bcrypt.checkpw(password.encode('utf-8'), hashed_password)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Return the shared, bounded pool hashing passwords: bcrypt releases
+    the GIL, so its threads run on as many cores
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS,
+                                           thread_name_prefix="bcrypt")
+        return _executor
+
+
+def _map_bounded(func: Callable, items: Iterable[tuple]) -> List:
+    """
+    Apply `func` to every argument tuple of `items` on the shared pool,
+    with at most twice as many calls in flight as there are workers,
+    and return the results in order
+    """
+    executor = get_executor()
+    results = []
+    pending = deque()
+    for args in items:
+        if len(pending) >= 2 * MAX_WORKERS:
+            results.append(pending.popleft().result())
+        pending.append(executor.submit(func, *args))
+    results.extend(future.result() for future in pending)
+    return results
+
+
+def hash_passwords(passwords: Iterable[str]) -> List[bytes]:
+    """
+    Hash many passwords in parallel, in the order given
+    """
+    return _map_bounded(hash_password, ((p,) for p in passwords))
+
+
+def are_valid(pairs: Iterable[Tuple[bytes, str]]) -> List[bool]:
+    """
+    Check many (hashed_password, password) pairs in parallel, in the
+    order given
+    """
+    return _map_bounded(is_valid, pairs)
+
+
+async def ahash_password(password: str) -> bytes:
+    """
+    Hash a password on the shared pool without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), hash_password,
+                                      password)
+
+
+async def ais_valid(hashed_password: bytes, password: str) -> bool:
+    """
+    Validate a password on the shared pool without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), is_valid,
+                                      hashed_password, password)
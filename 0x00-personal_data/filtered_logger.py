@@ -2,18 +2,93 @@
 """
 Replace and format occur of certain field values
 """
+import atexit
+import copy
+import json
+import mmap
 import os
 import logging
+import queue
 import re
-from typing import List
+import shutil
+import sys
+import tempfile
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import (Any, Callable, FrozenSet, Iterator, List, Pattern,
+                    TextIO, Tuple, Union)
 import mysql.connector
 
 
+PATTERN_CACHE_SIZE = int(os.getenv("PERSONAL_DATA_PATTERN_CACHE_SIZE", 128))
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def redaction_pattern(fields: Tuple[str, ...], separator: str,
+                      redaction: str) -> Tuple[Pattern, str]:
+    """
+    Compile (once per fields/separator/redaction) the regex used to
+    obfuscate field values, together with its replacement template
+    """
+    return (re.compile(fr'({"|".join(fields)})=[^{separator}]+'),
+            f'\\1={redaction}')
+
+
 def filter_datum(fields: List[str],
                  redaction: str, message: str, separator: str) -> str:
     """func using regex to replace occur of certain field values"""
-    return re.sub(fr'({"|".join(fields)})=[^{separator}]+',
-                  f'\\1={redaction}', message)
+    pattern, replacement = redaction_pattern(tuple(fields), separator,
+                                             redaction)
+    return pattern.sub(replacement, message)
+
+
+def _scan_redact(keys: FrozenSet[str], tails: FrozenSet[str],
+                 lengths: Tuple[int, ...], redaction: str,
+                 message: str, separator: str) -> str:
+    """
+    Redact `message` in a single scan, without regex: split it on
+    `separator` and, in each segment, replace the value following the
+    first '=' whose preceding text ends with one of `keys`.
+    `tails` holds the last character and `lengths` the lengths of the keys
+    """
+    parts = message.split(separator)
+    n = -1
+    for part in parts:
+        n += 1
+        eq = part.find('=')
+        # like `[^;]+`, a key needs a non empty value to be redacted
+        while eq != -1 and eq + 1 < len(part):
+            key = part[:eq]
+            if key[-1:] in tails:
+                if key.lstrip() in keys:
+                    parts[n] = key + '=' + redaction
+                    break
+                for length in lengths:
+                    if key[-length:] in keys:
+                        parts[n] = key + '=' + redaction
+                        eq = -1
+                        break
+                else:
+                    eq = part.find('=', eq + 1)
+            else:
+                eq = part.find('=', eq + 1)
+    return separator.join(parts)
+
+
+def scan_filter_datum(fields: List[str],
+                      redaction: str, message: str, separator: str) -> str:
+    """
+    Regex free counterpart of filter_datum, giving the same output for
+    plain field names and a single character separator
+    """
+    keys = frozenset(fields)
+    return _scan_redact(keys, frozenset(f[-1] for f in keys),
+                        tuple({len(f) for f in keys}),
+                        redaction, message, separator)
 
 
 class RedactingFormatter(logging.Formatter):
@@ -23,24 +98,224 @@ class RedactingFormatter(logging.Formatter):
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
+    ENGINES = ("regex", "scan")
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], engine: str = "regex",
+                 structured: bool = False):
         super(RedactingFormatter, self).__init__(self.FORMAT)
+        if engine not in self.ENGINES:
+            raise ValueError("engine must be one of {}".format(self.ENGINES))
         self.fields = fields
+        self.engine = engine
+        self.structured = structured
+        self._keys = frozenset(fields)
+        self._pattern, self._replacement = redaction_pattern(
+            tuple(fields), self.SEPARATOR, self.REDACTION)
+        if engine == "scan":
+            if len(self.SEPARATOR) != 1 or not fields or any(
+                    not f or '=' in f or re.escape(f) != f for f in fields):
+                raise ValueError("scan engine needs a one character "
+                                 "separator and plain field names")
+            self._tails = frozenset(f[-1] for f in self._keys)
+            self._lengths = tuple({len(f) for f in self._keys})
+
+    def redact(self, value: Any) -> Any:
+        """Return a copy of `value` where every dict entry whose key is one
+        of the fields is replaced by REDACTION, at any depth
+        """
+        if isinstance(value, dict):
+            return {k: self.REDACTION if k in self._keys else self.redact(v)
+                    for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.redact(v) for v in value]
+        return value
 
     def format(self, record: logging.LogRecord) -> str:
         """This function filters the specified fields
         """
-        return filter_datum(self.fields, self.REDACTION,
-                            super().format(record), self.SEPARATOR)
+        if self.structured:
+            # redact by key, no regex pass needed: a dict message is
+            # logged as JSON, dict arguments fill the message template
+            if isinstance(record.msg, dict):
+                record = copy.copy(record)
+                record.msg = json.dumps(self.redact(record.msg),
+                                        default=str)
+                record.args = None
+                return super().format(record)
+            if isinstance(record.args, dict):
+                record = copy.copy(record)
+                record.args = self.redact(record.args)
+                return super().format(record)
+        if self.engine == "scan":
+            return _scan_redact(self._keys, self._tails, self._lengths,
+                                self.REDACTION, super().format(record),
+                                self.SEPARATOR)
+        return self._pattern.sub(self._replacement, super().format(record))
 
 
 PII_FIELDS = ("name", "email", "phone", "ssn", "password")
+SCRUB_CHUNK_SIZE = 64 * 1024 * 1024
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
 
 
-def get_logger() -> logging.Logger:
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def bytes_redaction_pattern(fields: Tuple[str, ...], separator: bytes,
+                            per_line: bool = False) -> Pattern:
+    """
+    Compile the bytes counterpart of redaction_pattern; with `per_line`
+    a value also stops at the end of its line
+    """
+    stop = separator + (b'\\n' if per_line else b'')
+    return re.compile(b'(' + '|'.join(fields).encode() + b')=[^' +
+                      stop + b']+')
+
+
+def redact_bytes_into(pattern: Pattern, redaction: bytes, data: Buffer,
+                      out: bytearray, start: int = 0, end: int = None) -> int:
+    """
+    Write data[start:end], its matches of `pattern` redacted, at the
+    beginning of the preallocated `out` (which only grows when too small)
+    without ever decoding it. Returns the number of bytes written
+    """
+    with memoryview(data) as view:
+        end = len(view) if end is None else end
+        pos = 0
+        last = start
+        for match in pattern.finditer(view, start, end):
+            value = match.end(1) + 1
+            chunk = value - last
+            out[pos:pos + chunk] = view[last:value]
+            pos += chunk
+            out[pos:pos + len(redaction)] = redaction
+            pos += len(redaction)
+            last = match.end()
+        chunk = end - last
+        out[pos:pos + chunk] = view[last:end]
+        return pos + chunk
+
+
+def filter_datum_bytes(fields: List[str], redaction: bytes, message: Buffer,
+                       separator: bytes) -> bytearray:
+    """
+    Bytes counterpart of filter_datum, working on bytes, bytearray,
+    memoryview or mmap messages without decoding them
+    """
+    pattern = bytes_redaction_pattern(tuple(fields), separator)
+    out = bytearray(len(message) + len(message) // 8)
+    del out[redact_bytes_into(pattern, redaction, message, out):]
+    return out
+
+
+def scrub_file(src: str, dst: str, fields: List[str] = PII_FIELDS,
+               redaction: bytes = b"***", separator: bytes = b";",
+               chunk_size: int = SCRUB_CHUNK_SIZE) -> int:
+    """
+    Redact the log file `src` into `dst`: `src` is memory mapped and
+    processed `chunk_size` bytes at a time, every chunk being cut after
+    a newline so that no record straddles two chunks. Each line is a
+    record, a value never spans past its end.
+    Returns the number of bytes written
+    """
+    pattern = bytes_redaction_pattern(tuple(fields), separator, True)
+    written = 0
+    with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+        size = os.fstat(f_in.fileno()).st_size
+        if size == 0:
+            return 0
+        with mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            out = bytearray(chunk_size + chunk_size // 8)
+            start = 0
+            while start < size:
+                end = min(start + chunk_size, size)
+                if end < size:
+                    cut = mm.rfind(b'\n', start, end)
+                    if cut == -1:
+                        # a record longer than a chunk: extend to its end
+                        cut = mm.find(b'\n', end)
+                    end = size if cut == -1 else cut + 1
+                length = redact_bytes_into(pattern, redaction, mm, out,
+                                           start, end)
+                with memoryview(out) as view:
+                    f_out.write(view[:length])
+                written += length
+                start = end
+    return written
+
+
+class OverflowQueueHandler(QueueHandler):
+    """ QueueHandler applying an overflow policy once its queue is full:
+    "block" waits for room, "drop" discards the record and "sample"
+    keeps one overflowing record out of `sample_rate`, in place of the
+    oldest queued one
+    """
+
+    POLICIES = ("block", "drop", "sample")
+
+    def __init__(self, log_queue: queue.Queue, overflow: str = "block",
+                 sample_rate: int = 10):
+        super(OverflowQueueHandler, self).__init__(log_queue)
+        if overflow not in self.POLICIES:
+            raise ValueError("overflow must be one of {}".format(
+                self.POLICIES))
+        self.overflow = overflow
+        self.sample_rate = max(sample_rate, 1)
+        self.dropped = 0
+        self.listener = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Enqueue the record untouched: the message is rendered and
+        redacted by the listener thread, not by the caller
+        """
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        """Put the record on the queue according to the overflow policy
+        """
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.overflow == "sample" and \
+                    self.dropped % self.sample_rate == 0:
+                # make room by evicting the oldest record, never waiting:
+                # the sampled record is then dropped instead if another
+                # caller took the room first
+                try:
+                    self.queue.get_nowait()
+                    self.queue.put_nowait(record)
+                except (queue.Empty, queue.Full):
+                    pass
+
+
+class DrainingQueueListener(QueueListener):
+    """ QueueListener that can be stopped more than once and waits for
+    room in a full queue to post its stop sentinel
+    """
+
+    def enqueue_sentinel(self):
+        """Post the stop sentinel, blocking while the queue is full"""
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        """Process the remaining records then stop, if still running"""
+        if self._thread is not None:
+            super(DrainingQueueListener, self).stop()
+
+
+def get_logger(queued: bool = False, queue_size: int = 10000,
+               overflow: str = "block") -> logging.Logger:
     """
     Creates a logger object for the user_data
+
+    With `queued`, callers only enqueue their records: a QueueListener
+    thread redacts and writes them, `queue_size` bounds the backlog and
+    `overflow` ("block", "drop" or "sample") says what to do when full
     """
     logger = logging.getLogger("user_data")
     logger.setLevel(logging.INFO)
@@ -50,7 +325,16 @@ def get_logger() -> logging.Logger:
     formatter = RedactingFormatter(list(PII_FIELDS))
     stream_handler.setFormatter(formatter)
 
-    logger.addHandler(stream_handler)
+    if queued:
+        queue_handler = OverflowQueueHandler(queue.Queue(queue_size),
+                                             overflow)
+        queue_handler.listener = DrainingQueueListener(queue_handler.queue,
+                                                       stream_handler)
+        queue_handler.listener.start()
+        atexit.register(queue_handler.listener.stop)
+        logger.addHandler(queue_handler)
+    else:
+        logger.addHandler(stream_handler)
 
     return logger
 
@@ -74,20 +358,315 @@ def get_db() -> mysql.connector.connection.MySQLConnection:
     return connection
 
 
+class DBPool:
+    """ Small pool of database connections: connections are checked
+    before being handed out and their session is reset when they come
+    back, so that jobs stop paying a TCP and auth handshake per call
+    """
+
+    def __init__(self, size: int = None, timeout: float = None,
+                 factory: Callable = None):
+        """
+        `size` and `timeout` default to PERSONAL_DATA_DB_POOL_SIZE and
+        PERSONAL_DATA_DB_POOL_TIMEOUT; `factory` opens a new connection
+        and defaults to get_db
+        """
+        if size is None:
+            size = int(os.getenv("PERSONAL_DATA_DB_POOL_SIZE", 5))
+        if timeout is None:
+            timeout = float(os.getenv("PERSONAL_DATA_DB_POOL_TIMEOUT", 30))
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        self.size = size
+        self.timeout = timeout
+        self.factory = factory or get_db
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @staticmethod
+    def is_healthy(connection) -> bool:
+        """Check that an idle connection can still be used"""
+        try:
+            is_connected = getattr(connection, "is_connected", None)
+            return is_connected is None or bool(is_connected())
+        except Exception:
+            return False
+
+    @staticmethod
+    def discard(connection):
+        """Close a connection that goes out of the pool"""
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """
+        Hand out an idle, healthy connection, or open a new one while
+        fewer than `size` are in use. Raises TimeoutError when none
+        frees up within `timeout` seconds
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("no database connection available")
+        try:
+            while True:
+                try:
+                    connection = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.factory()
+                if self.is_healthy(connection):
+                    return connection
+                self.discard(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection):
+        """
+        Give a connection back: its session is reset (pending transaction
+        rolled back, session variables cleared) before it is reused
+        """
+        try:
+            reset_session = getattr(connection, "reset_session", None)
+            if reset_session is not None:
+                reset_session()
+            self._idle.put(connection)
+        except Exception:
+            self.discard(connection)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager lending a connection for the block"""
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self):
+        """Close every idle connection"""
+        while True:
+            try:
+                self.discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_db_pool() -> DBPool:
+    """
+    Return the process wide DBPool, configured from the environment
+    """
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = DBPool()
+            atexit.register(_db_pool.close)
+        return _db_pool
+
+
+@contextmanager
+def pooled_db():
+    """
+    Borrow a connection of the process wide pool for a `with` block
+    """
+    with get_db_pool().connection() as connection:
+        yield connection
+
+
+def row_template(fields: List[str]) -> str:
+    """
+    Build, once per query, the %-template turning a users row into
+    the `field=value; ` message logged for it
+    """
+    return ' '.join('{}=%s;'.format(f.replace('%', '%%')) for f in fields)
+
+
+def fetch_messages(cursor, batch_size: int) -> Iterator[List[str]]:
+    """
+    Yield the `field=value; ` messages of an executed users query,
+    one list of at most `batch_size` messages at a time
+    """
+    template = row_template([i[0] for i in cursor.description])
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield [template % row for row in rows]
+
+
+def export_users(logger: logging.Logger,
+                 db: mysql.connector.connection.MySQLConnection,
+                 batch_size: int = 1000) -> int:
+    """
+    Stream the users table through `logger` with an unbuffered cursor,
+    `batch_size` rows at a time, so memory stays bounded whatever the
+    size of the table. Returns the number of rows exported
+    """
+    cursor = db.cursor(buffered=False)
+    count = 0
+    try:
+        cursor.execute("SELECT * FROM users")
+        enabled = logger.isEnabledFor(logging.INFO)
+        for messages in fetch_messages(cursor, batch_size):
+            count += len(messages)
+            if not enabled:
+                continue
+            # skip logger.info, which walks the stack for every record
+            for msg in messages:
+                logger.handle(logger.makeRecord(
+                    logger.name, logging.INFO, "(unknown file)", 0,
+                    msg, None, None))
+    finally:
+        cursor.close()
+    return count
+
+
+def export_range(key: str, start: int, stop: int,
+                 path: str, batch_size: int = 1000) -> int:
+    """
+    Worker of export_users_parallel: redact the users whose `key` is in
+    [start, stop) - or NULL when start is None, or, without key, the
+    whole table - into the file at `path`, over its own connection.
+    Returns the number of rows exported
+    """
+    formatter = RedactingFormatter(list(PII_FIELDS))
+    db = get_db()
+    cursor = db.cursor(buffered=False)
+    count = 0
+    try:
+        if key and start is None:
+            cursor.execute("SELECT * FROM users WHERE `{}` IS NULL"
+                           .format(key))
+        elif key:
+            cursor.execute("SELECT * FROM users WHERE `{0}` >= %s AND "
+                           "`{0}` < %s ORDER BY `{0}`".format(key),
+                           (start, stop))
+        else:
+            cursor.execute("SELECT * FROM users")
+        with open(path, 'w') as out:
+            for messages in fetch_messages(cursor, batch_size):
+                count += len(messages)
+                out.writelines(formatter.format(logging.LogRecord(
+                    "user_data", logging.INFO, "(unknown file)", 0,
+                    msg, None, None)) + '\n' for msg in messages)
+    finally:
+        cursor.close()
+        db.close()
+    return count
+
+
+def primary_key(cursor) -> str:
+    """
+    Name of the single column primary key of the users table, or None
+    """
+    cursor.execute("SELECT COLUMN_NAME FROM information_schema."
+                   "KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = DATABASE() AND "
+                   "TABLE_NAME = 'users' AND CONSTRAINT_NAME = 'PRIMARY'")
+    columns = cursor.fetchall()
+    return columns[0][0] if len(columns) == 1 else None
+
+
+def export_users_parallel(workers: int, key: str = None,
+                          output: TextIO = None,
+                          batch_size: int = 1000) -> int:
+    """
+    Export the users table with `workers` processes: the table is split
+    into ranges of its integer `key` column (the primary key when no key
+    is given), each range is redacted by export_range into its own file
+    and the files are appended in range order to `output` (stderr, like
+    the "user_data" logger, by default); a last range holds the users
+    whose key is NULL. Without an integer primary key the table is
+    exported by a single worker, with a RuntimeWarning.
+    Returns the number of rows exported
+    """
+    if key and '`' in key:
+        raise ValueError("invalid key column: {}".format(key))
+    output = sys.stderr if output is None else output
+    db = get_db()
+    cursor = db.cursor()
+    detected = not key
+    if detected:
+        key = primary_key(cursor)
+    if key and '`' not in key:
+        cursor.execute("SELECT MIN(`{0}`), MAX(`{0}`) FROM users".format(
+            key))
+        low, high = cursor.fetchone()
+        if any(type(bound) not in (int, type(None))
+               for bound in (low, high)):
+            if not detected:
+                raise ValueError("key column {} is not an integer column"
+                                 .format(key))
+            key = None
+    else:
+        key = None
+    cursor.close()
+    db.close()
+
+    if key is None:
+        warnings.warn("users has no integer primary key: exported by a "
+                      "single worker; set PERSONAL_DATA_EXPORT_KEY to an "
+                      "integer column to split it", RuntimeWarning)
+        bounds = [(None, None)]
+    else:
+        bounds = []
+        if low is not None:
+            # a few ranges per worker so that uneven ranges balance out
+            high += 1
+            shards = min(workers * 4, high - low)
+            step = -(-(high - low) // shards)
+            bounds = [(lo, min(lo + step, high))
+                      for lo in range(low, high, step)]
+        # the range conditions never match a NULL key
+        bounds.append((None, None))
+    count = 0
+    with tempfile.TemporaryDirectory(prefix="user_data_") as tmp_dir:
+        paths = [os.path.join(tmp_dir, "{}.log".format(n))
+                 for n in range(len(bounds))]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(export_range, key, lo, hi, path,
+                                       batch_size)
+                       for (lo, hi), path in zip(bounds, paths)]
+            for future, path in zip(futures, paths):
+                count += future.result()
+                with open(path) as part:
+                    shutil.copyfileobj(part, output)
+                os.remove(path)
+    output.flush()
+    return count
+
+
 def main():
     """
     Set up logging with the configured "user_data" logger
     """
+    workers = int(os.getenv("PERSONAL_DATA_EXPORT_WORKERS", 1))
+    batch_size = int(os.getenv("PERSONAL_DATA_BATCH_SIZE", 0))
+    if workers > 1:
+        export_users_parallel(workers, os.getenv("PERSONAL_DATA_EXPORT_KEY"),
+                              batch_size=batch_size or 1000)
+        return
+
     info_logger = get_logger()
 
     db_connection = get_db()
 
+    if batch_size > 0:
+        export_users(info_logger, db_connection, batch_size)
+        db_connection.close()
+        return
+
     cursor = db_connection.cursor()
     cursor.execute("SELECT * FROM users")
     fields = [i[0] for i in cursor.description]
 
     for row in cursor:
-        msg = ''.join(f'{f}={str(r)}; ' for val, f in zip(row, fields))
+        msg = ''.join(f'{f}={str(val)}; ' for val, f in zip(row, fields))
         info_logger.info(msg.strip())
 
     db_connection.close()
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+"""
+Re-scrub archived log files with the current PII_FIELDS:
+./scrub_logs.py SOURCE DESTINATION
+"""
+import sys
+
+scrub_file = __import__('filtered_logger').scrub_file
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: {} SOURCE DESTINATION".format(sys.argv[0]))
+    print("{} bytes written".format(scrub_file(sys.argv[1], sys.argv[2])))
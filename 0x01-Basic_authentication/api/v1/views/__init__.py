@@ -2,10 +2,16 @@
 """ DocDocDocDocDocDoc
 """
 from flask import Blueprint
+from os import getenv
 
 app_views = Blueprint("app_views", __name__, url_prefix="/api/v1")
 
 from api.v1.views.index import *
 from api.v1.views.users import *
 
-User.load_from_file()
+# BASE_LAZY_LOAD=1 loads the users on first use, =warm in the background
+lazy_load = getenv('BASE_LAZY_LOAD', '0')
+if lazy_load == '0':
+    User.load_from_file()
+else:
+    User.lazy_load(warm_up=lazy_load == 'warm')
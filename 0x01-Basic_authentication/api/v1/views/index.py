@@ -14,6 +14,19 @@ def status() -> str:
     return jsonify({"status": "OK"})
 
 
+@app_views.route('/ready', methods=['GET'], strict_slashes=False)
+def ready() -> str:
+    """ GET /api/v1/ready
+    Return:
+      - whether the models serve requests without waiting (see
+        Base.is_ready): 200, or 503 while warming up
+    """
+    from models.base import Base
+    if Base.is_ready():
+        return jsonify({"ready": True})
+    return jsonify({"ready": False}), 503
+
+
 @app_views.route('/stats/', strict_slashes=False)
 def stats() -> str:
     """ GET /api/v1/stats
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+""" SQLite storage engine of the Base models
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+from os import getenv
+from typing import TypeVar, Iterator, List
+import json
+import queue
+import sqlite3
+import threading
+
+
+# SQL operators of the Base.search lookups (startswith is a range)
+SQL_OPERATORS = {'exact': '=', 'gt': '>', 'gte': '>=', 'lt': '<',
+                 'lte': '<='}
+
+
+class SQLiteStorage():
+    """ Stores each model class in its own SQLite table: the object as
+    JSON, plus one indexed column per attribute of the class
+    __indexes__ and __sorted_indexes__. The database runs in WAL mode
+    so that several worker processes can share it
+    """
+
+    def __init__(self, db_path: str, pool_size: int = None):
+        """ Initialize a storage backed by the database file db_path,
+        keeping up to pool_size (BASE_SQLITE_POOL_SIZE) idle connections
+        """
+        self.db_path = db_path
+        if pool_size is None:
+            pool_size = int(getenv('BASE_SQLITE_POOL_SIZE', 8))
+        # last in, first out: the busiest connections, whose statement
+        # caches are warm, are reused first
+        self._idle = queue.LifoQueue(maxsize=max(pool_size, 1))
+        self._lock = threading.Lock()
+        self._tables = {}
+        self._queries = {}
+
+    def connect(self) -> sqlite3.Connection:
+        """ New connection to the database, usable from any thread (one
+        thread at a time, see connection)
+        """
+        conn = sqlite3.connect(self.db_path, isolation_level=None,
+                               cached_statements=256,
+                               check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """ Connection of the pool, lent to the calling thread for a with
+        block: the request threads, short-lived, share the connections
+        and their prepared statements instead of opening their own
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def close(self):
+        """ Close the idle connections
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def columns(self, cls) -> tuple:
+        """ Indexed columns of the class table, created (or completed with
+        the attributes newly added to __indexes__) on first use
+        """
+        s_class = cls.__name__
+        columns = self._tables.get(s_class)
+        if columns is not None:
+            return columns
+
+        with self._lock:
+            columns = tuple(attr for attr in dict.fromkeys(
+                cls.__indexes__ + cls.__sorted_indexes__)
+                if attr.isidentifier())
+            with self.connection() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS "{}" '
+                             '(id TEXT PRIMARY KEY, data TEXT NOT NULL)'
+                             .format(s_class))
+                existing = {row[1] for row in conn.execute(
+                    'PRAGMA table_info("{}")'.format(s_class))}
+                for column in columns:
+                    if column not in existing:
+                        conn.execute('ALTER TABLE "{0}" ADD COLUMN "{1}"'
+                                     .format(s_class, column))
+                        conn.execute('UPDATE "{0}" SET "{1}" = '
+                                     'json_extract(data, \'$.{1}\')'
+                                     .format(s_class, column))
+                    conn.execute('CREATE INDEX IF NOT EXISTS "{0}_{1}" '
+                                 'ON "{0}" ("{1}")'.format(s_class, column))
+            self._tables[s_class] = columns
+        return columns
+
+    def query(self, cls, key: tuple, build) -> str:
+        """ SQL of a statement, built once per class and key: the same
+        string is then reused, so sqlite3 keeps it prepared
+        """
+        sql = self._queries.get((cls.__name__, key))
+        if sql is None:
+            sql = build(cls.__name__, self.columns(cls))
+            self._queries[(cls.__name__, key)] = sql
+        return sql
+
+    @staticmethod
+    def column_value(value):
+        """ Value of an attribute as stored in an indexed column
+        """
+        if type(value) is datetime:
+            from models.base import TIMESTAMP_FORMAT
+            return value.strftime(TIMESTAMP_FORMAT)
+        if value is None or type(value) in (str, int, float, bytes):
+            return value
+        return str(value)
+
+    def save_sql(self, cls) -> str:
+        """ Statement inserting or updating one object of the class
+        """
+        return self.query(cls, ('save',), lambda table, columns: (
+            'INSERT INTO "{}" (id, data{}) VALUES (?, ?{}) ON CONFLICT(id) '
+            'DO UPDATE SET data = excluded.data{}'.format(
+                table, ''.join(', "{}"'.format(c) for c in columns),
+                ', ?' * len(columns),
+                ''.join(', "{0}" = excluded."{0}"'.format(c)
+                        for c in columns))))
+
+    def row(self, obj: TypeVar('Base')) -> list:
+        """ Parameters of the save statement for one object
+        """
+        values = [obj.id, json.dumps(obj.to_json(True))]
+        values.extend(self.column_value(getattr(obj, column, None))
+                      for column in self.columns(obj.__class__))
+        return values
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or update one object
+        """
+        sql, row = self.save_sql(obj.__class__), self.row(obj)
+        with self.connection() as conn:
+            conn.execute(sql, row)
+
+    def save_many(self, cls, objs: List[TypeVar('Base')]):
+        """ Insert or update objects of the class, in one transaction
+        """
+        sql = self.save_sql(cls)
+        with self.transaction() as conn:
+            conn.executemany(sql, (self.row(obj) for obj in objs))
+
+    def remove_sql(self, cls) -> str:
+        """ Statement deleting one object of the class by id
+        """
+        return self.query(cls, ('remove',), lambda table, columns:
+                          'DELETE FROM "{}" WHERE id = ?'.format(table))
+
+    def remove(self, cls, obj_id: str) -> bool:
+        """ Delete one object by id, and return whether it existed
+        """
+        sql = self.remove_sql(cls)
+        with self.connection() as conn:
+            return conn.execute(sql, (obj_id,)).rowcount > 0
+
+    def remove_many(self, cls, ids: List[str]) -> List[str]:
+        """ Delete objects of the class by id, in one transaction, and
+        return the ids of those deleted
+        """
+        sql = self.remove_sql(cls)
+        with self.transaction() as conn:
+            return [obj_id for obj_id in ids
+                    if conn.execute(sql, (obj_id,)).rowcount > 0]
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """ Connection of the pool, inside a transaction committed on
+        success and rolled back on error
+        """
+        with self.connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def count(self, cls) -> int:
+        """ Number of objects of the class
+        """
+        sql = self.query(cls, ('count',), lambda table, columns:
+                         'SELECT COUNT(*) FROM "{}"'.format(table))
+        with self.connection() as conn:
+            return conn.execute(sql).fetchone()[0]
+
+    def get(self, cls, obj_id: str) -> TypeVar('Base'):
+        """ One object by id, or None
+        """
+        sql = self.query(cls, ('get',), lambda table, columns:
+                         'SELECT data FROM "{}" WHERE id = ?'.format(table))
+        with self.connection() as conn:
+            row = conn.execute(sql, (obj_id,)).fetchone()
+        return None if row is None else cls.from_json(json.loads(
+            row[0]))
+
+    def search(self, cls, attributes: dict = {}, order_by: str = None,
+               limit: int = None) -> List[TypeVar('Base')]:
+        """ Objects matching the search conditions (see Base.search): the
+        conditions, ordering and limit on the id and the indexed
+        attributes are applied by SQLite, the others on the loaded objects
+        """
+        from models.base import (matches, parse_conditions, prefix_end,
+                                 sort_objects)
+        columns = self.columns(cls)
+        conditions = parse_conditions(attributes)
+        where = []
+        params = []
+        in_sql = True
+        for attr, lookup, arg in conditions:
+            if attr != 'id' and attr not in columns:
+                in_sql = False
+                continue
+            value = self.column_value(arg)
+            if lookup == 'startswith':
+                where.append((attr, '>='))
+                params.append(value)
+                end = prefix_end(value)
+                if end is not None:
+                    where.append((attr, '<'))
+                    params.append(end)
+            else:
+                where.append((attr, 'IS' if value is None
+                              else SQL_OPERATORS[lookup]))
+                params.append(value)
+
+        order_attr = order_by.lstrip('-') if order_by else None
+        ordered = order_attr is not None and \
+            (order_attr == 'id' or order_attr in columns)
+        order = 'rowid'
+        if ordered:
+            # objects without a value last, as in Base.search
+            order = '"{0}" IS NULL, "{0}"{1}'.format(
+                order_attr, ' DESC' if order_by[0] == '-' else '')
+        # the limit goes to SQLite when no object is filtered or sorted
+        # after the query
+        sql_limit = limit is not None and in_sql and \
+            (ordered or order_attr is None)
+        if sql_limit:
+            params.append(limit)
+        sql = self.query(
+            cls, ('search', tuple(where), order, sql_limit),
+            lambda table, columns: 'SELECT data FROM "{}"{}{} ORDER BY {}{}'
+            .format(table, ' WHERE ' if where else '',
+                    ' AND '.join('"{}" {} ?'.format(attr, operator)
+                                 for attr, operator in where),
+                    order, ' LIMIT ?' if sql_limit else ''))
+        with self.connection() as conn:
+            rows = conn.execute(sql, params)
+            result = (obj for obj in (cls.from_json(json.loads(row[0]))
+                                      for row in rows)
+                      if matches(obj, conditions))
+            if order_attr is not None and not ordered:
+                result = sort_objects(result, order_by)
+            return list(islice(result, limit))
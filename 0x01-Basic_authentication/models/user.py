@@ -9,6 +9,11 @@ class User(Base):
     """ User class
     """
 
+    __slots__ = ('email', '_password', 'first_name', 'last_name')
+    __indexes__ = ('email',)
+    __sorted_indexes__ = ('created_at', 'email')
+    __mmap_snapshot__ = True
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance
         """
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+""" Stress test of the Base store under threads: writers save, remove
+and reload users while readers check that they always see the users
+never removed, whole (see WRITE_LOCK in models/base.py)
+./stress_base.py [seconds]
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from models.user import User
+
+SEEDS = 200
+WRITERS = 3
+READERS = 4
+
+os.chdir(tempfile.mkdtemp())
+duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+User.load_from_file()
+seeds = [User(email="seed{:03d}@hbtn.io".format(n)) for n in range(SEEDS)]
+User.save_many(seeds)
+
+stop = threading.Event()
+errors = []
+checks = [0] * READERS
+
+
+def write(n: int):
+    """ Writer: churn of users other than the seeds
+    """
+    rng = random.Random(n)
+    own = []
+    while not stop.is_set():
+        op = rng.randrange(10)
+        if op < 4:
+            user = User(email="w{}-{}@hbtn.io".format(n, rng.random()))
+            user.save()
+            own.append(user)
+        elif op < 6 and own:
+            own.pop(rng.randrange(len(own))).remove()
+        elif op < 8:
+            batch = [User(email="b{}-{}@hbtn.io".format(n, rng.random()))
+                     for _ in range(20)]
+            User.save_many(batch)
+            own.extend(batch)
+        elif op < 9 and own:
+            User.remove_many(user.id for user in own[:20])
+            del own[:20]
+        else:
+            User.load_from_file()
+
+
+def read(n: int):
+    """ Reader: the seeds must always be found, and only them
+    """
+    rng = random.Random(100 + n)
+    while not stop.is_set():
+        try:
+            seed = rng.choice(seeds)
+            assert User.get(seed.id) is not None, "get lost a seed"
+            found = User.search({'email': seed.email})
+            assert [u.id for u in found] == [seed.id], "search by email"
+            found = User.search({'email__startswith': "seed"},
+                                order_by='email')
+            assert [u.email for u in found] == \
+                [s.email for s in seeds], "ordered prefix search"
+            assert User.count() >= SEEDS, "count below the seeds"
+            assert sum(1 for u in User.all()
+                       if u.email.startswith("seed")) == SEEDS, "all"
+            checks[n] += 1
+        except Exception as e:
+            errors.append("{}: {}".format(type(e).__name__, e))
+
+
+threads = [threading.Thread(target=write, args=(n,))
+           for n in range(WRITERS)]
+threads += [threading.Thread(target=read, args=(n,))
+            for n in range(READERS)]
+for thread in threads:
+    thread.start()
+time.sleep(duration)
+stop.set()
+for thread in threads:
+    thread.join()
+
+print("{} writers, {} readers, {:.0f} s: {} checks, {} errors".format(
+    WRITERS, READERS, duration, sum(checks), len(errors)))
+for error in sorted(set(errors)):
+    print(error)
+print("OK" if not errors and all(checks) else "FAILED")
@@ -32,6 +32,7 @@ else:
     auth = Auth()
 
 ex_paths = ['/api/v1/status/',
+            '/api/v1/ready/',
             '/api/v1/unauthorized/',
             '/api/v1/forbidden/',
             '/api/v1/auth_session/login',
@@ -81,4 +82,4 @@ def forbidden(error) -> str:
 if __name__ == "__main__":
     host = getenv("API_HOST", "0.0.0.0")
     port = getenv("API_PORT", "5000")
-    app.run(host=host, port=port)
+    app.run(host=host, port=port, threaded=True)
@@ -31,7 +31,7 @@ class SessionDBAuth(SessionExpAuth):
         if session_id is None:
             return None
 
-        UserSession.load_from_file()
+        UserSession.refresh()
         user_session = UserSession.search({'session_id': session_id})
         if len(user_session) == 0:
             return None
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+""" Memory benchmark: memory held by DATA once User.load_from_file has
+loaded N users (1,000,000 by default), and peak memory of the load, with
+datetime and with epoch int timestamps (measured with tracemalloc)
+./benchmark_memory.py [N]
+"""
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+
+VARIANTS = ("datetime", "epoch")
+
+
+def write_users(count: int):
+    """ Write .db_User.json with `count` users in the current directory
+    """
+    with open(".db_User.json", "w") as f:
+        f.write("{")
+        for n in range(count):
+            timestamp = "2017-09-25T01:55:{:02d}".format(n % 60)
+            user = {
+                "id": str(uuid.uuid4()),
+                "created_at": timestamp,
+                "updated_at": timestamp,
+                "email": "user{}@hbtn.io".format(n),
+                "_password": uuid.uuid4().hex * 2,
+                "first_name": "First{}".format(n),
+                "last_name": "Last{}".format(n),
+            }
+            f.write("{}{}: {}".format(", " if n else "",
+                                      json.dumps(user["id"]),
+                                      json.dumps(user)))
+        f.write("}")
+
+
+def measure(variant: str):
+    """ Child process: load the users and print what it took, as JSON
+    """
+    from models.base import DATA
+    from models.user import User
+    User.__epoch_timestamps__ = variant == "epoch"
+    start = time.perf_counter()
+    User.load_from_file()
+    seconds = time.perf_counter() - start
+
+    # load again, traced: tracemalloc slows the load down a lot
+    DATA.clear()
+    gc.collect()
+    tracemalloc.start()
+    User.load_from_file()
+    gc.collect()
+    held, peak = tracemalloc.get_traced_memory()
+    print(json.dumps({"users": User.count(), "seconds": seconds,
+                      "held": held, "peak": peak}))
+
+
+def main(count: int):
+    """ Run one child process per variant on a generated users file
+    """
+    project = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        write_users(count)
+        print("{:<10}{:>10}{:>10}{:>12}{:>12}{:>12}".format(
+            "variant", "users", "load s", "DATA MiB", "bytes/user",
+            "peak MiB"))
+        for variant in VARIANTS:
+            out = subprocess.run(
+                [sys.executable, os.path.join(project, "benchmark_memory.py"),
+                 "--child", variant],
+                check=True, stdout=subprocess.PIPE,
+                env=dict(os.environ, PYTHONPATH=project)).stdout
+            result = json.loads(out)
+            print("{:<10}{:>10}{:>10.2f}{:>12.1f}{:>12.0f}{:>12.1f}".format(
+                variant, result["users"], result["seconds"],
+                result["held"] / 2 ** 20, result["held"] / count,
+                result["peak"] / 2 ** 20))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        measure(sys.argv[2])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -1,27 +1,445 @@
 #!/usr/bin/env python3
 """ Base module
 """
-from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from operator import attrgetter, itemgetter
+from typing import Callable, TypeVar, List, Iterable, Iterator
+from glob import glob
+from os import getenv, path
+import atexit
+import fcntl
 import json
+import operator
+import os
+import queue
+import tempfile
+import threading
+import time
 import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from models.snapshot import Snapshot, write_snapshot
+from models.sorted_index import SortedIndex
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+EPOCH = datetime(1970, 1, 1)
 DATA = {}
+# INDEXES[class name][attribute][value] -> id of the saved object having
+# that value or, when several do, their ids in a dict used as an
+# insertion ordered set
+INDEXES = {}
+# SORTED_INDEXES[class name][attribute] -> SortedIndex of the values
+# (None excepted) and the ids of their objects
+SORTED_INDEXES = {}
+# INDEXED[class name][id] -> values under which the object is indexed
+INDEXED = {}
+
+
+def index_add(index: dict, value, obj_id: str):
+    """ Add an object id to a hash index under value
+    """
+    try:
+        ids = index.setdefault(value, obj_id)
+    except TypeError:
+        # unhashable values are left to the linear search
+        return
+    if type(ids) is dict:
+        ids[obj_id] = None
+    elif ids != obj_id:
+        index[value] = {ids: None, obj_id: None}
+
+
+def index_discard(index: dict, value, obj_id: str):
+    """ Remove an object id from a hash index under value
+    """
+    try:
+        ids = index.get(value)
+    except TypeError:
+        return
+    if type(ids) is dict:
+        ids.pop(obj_id, None)
+        if len(ids) == 1:
+            index[value] = next(iter(ids))
+    elif ids == obj_id:
+        del index[value]
+
+
+def range_lookup(compare):
+    """ Search lookup comparing the values with the argument, which
+    objects with no value never match
+    """
+    return lambda value, arg: value is not None and compare(value, arg)
+
+
+def startswith_lookup(value, arg: str) -> bool:
+    """ Search lookup matching the strings starting with the argument
+    """
+    return type(value) is str and value.startswith(arg)
+
+
+# LOOKUPS[name](value, argument): search conditions on attr__<name>
+LOOKUPS = {
+    'exact': operator.eq,
+    'gt': range_lookup(operator.gt),
+    'gte': range_lookup(operator.ge),
+    'lt': range_lookup(operator.lt),
+    'lte': range_lookup(operator.le),
+    'startswith': startswith_lookup,
+}
+
+
+def parse_conditions(attributes: dict) -> List[tuple]:
+    """ (attribute, lookup, argument) of each search condition
+    """
+    conditions = []
+    for key, arg in attributes.items():
+        attr, _, lookup = key.rpartition('__')
+        if not attr or lookup not in LOOKUPS:
+            attr, lookup = key, 'exact'
+        conditions.append((attr, lookup, arg))
+    return conditions
+
+
+def matches(obj, conditions: List[tuple]) -> bool:
+    """ Whether the object meets all the parsed search conditions
+    """
+    for attr, lookup, arg in conditions:
+        if not LOOKUPS[lookup](getattr(obj, attr), arg):
+            return False
+    return True
+
+
+def sort_objects(objs: Iterable, order_by: str) -> list:
+    """ Objects sorted on the attribute order_by ('-attr' for the
+    descending order), those without a value last
+    """
+    attr = order_by.lstrip('-')
+    get_value = attrgetter(attr)
+    objs = list(objs)
+    result = [obj for obj in objs if get_value(obj) is not None]
+    result.sort(key=get_value, reverse=order_by[0] == '-')
+    result.extend(obj for obj in objs if get_value(obj) is None)
+    return result
+
+
+def prefix_end(prefix: str) -> str:
+    """ Smallest string greater than all the strings starting with
+    prefix, None if there is none
+    """
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+# JSON_CACHE[class name] -> public JSON forms of all the objects, in
+# DATA order, and JSON_TEXTS[class name] -> the same encoded, both
+# dropped by invalidate_json
+JSON_CACHE = {}
+JSON_TEXTS = {}
+JSON_VERSIONS = {}
+
+
+def storage_mode() -> str:
+    """ Persistence mode of the objects, from BASE_STORAGE:
+    "json" (default) rewrites .db_<Class>.json on every change,
+    "journal" appends each change to .db_<Class>.journal,
+    "sqlite" keeps the objects in the BASE_SQLITE_PATH database
+    instead of DATA
+    """
+    return getenv('BASE_STORAGE', 'json')
+
+
+# SQLite engines, by database path
+SQLITE_STORAGES = {}
+
+
+def sqlite_storage():
+    """ SQLite engine in use, or None outside of the sqlite mode
+    """
+    if storage_mode() != 'sqlite':
+        return None
+    db_path = getenv('BASE_SQLITE_PATH', '.db.sqlite3')
+    storage = SQLITE_STORAGES.get(db_path)
+    if storage is None:
+        from models.sqlite_storage import SQLiteStorage
+        storage = SQLITE_STORAGES.setdefault(db_path, SQLiteStorage(db_path))
+    return storage
+
+
+def stream_load() -> bool:
+    """ With BASE_STREAM_LOAD=1, load_from_file parses the file object by
+    object instead of loading the whole JSON document first
+    """
+    return getenv('BASE_STREAM_LOAD', '0') == '1'
+
+
+def iter_json_object(f, chunk_size: int = 1 << 20) -> Iterator[tuple]:
+    """ Yield the (key, value) pairs of the JSON object stored in the
+    text file f, reading it chunk_size characters at a time
+    """
+    decoder = json.JSONDecoder()
+    whitespace = json.decoder.WHITESPACE
+    buf = ''
+    pos = 0
+    eof = False
+
+    def refill():
+        """ Drop the parsed text and read one more chunk, False at EOF """
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        buf = buf[pos:] + chunk
+        pos = 0
+        eof = not chunk
+        return not eof
+
+    def next_char() -> str:
+        """ First character after the whitespaces, '' at EOF """
+        nonlocal pos
+        while True:
+            pos = whitespace.match(buf, pos).end()
+            if pos < len(buf) or not refill():
+                return buf[pos:pos + 1]
+
+    def next_value():
+        """ Decode the JSON value starting at pos """
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # a value ending with the buffer may go on in the file,
+                # and so may a number cut after its '.', 'e' or sign
+                if eof or end < len(buf) and \
+                        buf[end] not in '0123456789.eE+-':
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            refill()
+
+    if next_char() != '{':
+        raise ValueError("a JSON object is expected")
+    pos += 1
+    if next_char() == '}':
+        return
+    while True:
+        key = next_value()
+        if next_char() != ':':
+            raise ValueError("':' expected at {}".format(pos))
+        pos += 1
+        next_char()
+        yield key, next_value()
+        separator = next_char()
+        pos += 1
+        if separator == '}':
+            return
+        if separator != ',':
+            raise ValueError("',' or '}}' expected at {}".format(pos))
+        next_char()
+
+
+def journal_max_bytes() -> int:
+    """ Size past which a journal is compacted into its snapshot
+    """
+    return int(getenv('BASE_JOURNAL_MAX_BYTES', 4 * 1024 * 1024))
+
+
+def shard_count() -> int:
+    """ Number of files, from BASE_SHARDS, the snapshot of a class is
+    split into by hash of the object ids: .db_<Class>.<n>-of-<N>.json
+    (1, the default, keeps the single .db_<Class>.json)
+    """
+    return max(1, int(getenv('BASE_SHARDS', 1)))
+
+
+def shard_of(obj_id: str, count: int) -> int:
+    """ Shard file, out of count, of an object id
+    """
+    return zlib.crc32(obj_id.encode()) % count
+
+
+def load_workers() -> int:
+    """ Threads reading the shard files of a class, BASE_LOAD_WORKERS
+    """
+    return int(getenv('BASE_LOAD_WORKERS', os.cpu_count() or 1))
+
+
+def read_snapshot(file_path: str) -> tuple:
+    """ (path, signature, (id, object JSON) pairs) of a snapshot file
+    """
+    with open(file_path, 'r') as f:
+        signature = file_signature(fd=f.fileno())
+        return file_path, signature, json.load(f).items()
+
+
+def mmap_snapshots() -> bool:
+    """ With BASE_MMAP_SNAPSHOT=1, the classes with __mmap_snapshot__
+    also write a binary snapshot, that the processes which have not
+    loaded the class (see lazy_load) map to answer get, count and the
+    searches on an indexed attribute
+    """
+    return getenv('BASE_MMAP_SNAPSHOT', '0') == '1'
+
+
+def write_behind() -> bool:
+    """ With BASE_WRITE_BEHIND=1, save_to_file only marks the class dirty
+    and a background thread writes the file, every BASE_FLUSH_INTERVAL
+    seconds or as soon as BASE_FLUSH_CHANGES changes are pending
+    """
+    return getenv('BASE_WRITE_BEHIND', '0') == '1'
+
+
+def change_stream_path() -> str:
+    """ File, from BASE_CHANGE_STREAM, every change of every class is
+    appended to as one JSON line (see read_changes), None when unset
+    """
+    return getenv('BASE_CHANGE_STREAM') or None
+
+
+def append_changes(entries: List[dict]):
+    """ Append changes to the change stream, in one write so that the
+    lines of concurrent processes do not interleave
+    """
+    with open(change_stream_path(), 'a') as f:
+        f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+
+def read_changes(offset: int = 0, file_path: str = None) -> tuple:
+    """ Changes of the complete lines of the change stream past offset,
+    and the offset to read from next time. A stream truncated below
+    offset (rotated) is read again from the start
+    """
+    file_path = file_path or change_stream_path()
+    try:
+        f = open(file_path, 'rb')
+    except FileNotFoundError:
+        return [], 0
+    changes = []
+    with f:
+        if os.fstat(f.fileno()).st_size < offset:
+            offset = 0
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                # still being written
+                break
+            changes.append(json.loads(line))
+            offset += len(line)
+    return changes, offset
+
+
+def follow_changes(offset: int = 0, file_path: str = None,
+                   interval: float = 1) -> Iterator[tuple]:
+    """ Yield the (changes, offset) of read_changes as lines are appended
+    to the change stream, checked every interval seconds, like tail -f
+    """
+    while True:
+        changes, offset = read_changes(offset, file_path)
+        if changes:
+            yield changes, offset
+        else:
+            time.sleep(interval)
+
+
+# serializes the writers: of DATA, of the indexes and of the .db_*
+# files. Readers never take it: they work on the dicts and lists as
+# they are when read, which writers change by single (GIL atomic)
+# operations or replace once complete
+WRITE_LOCK = threading.RLock()
+# classes (by name) whose file is behind DATA, and their pending changes
+DIRTY = {}
+# shards to write of the dirty classes, None for all
+DIRTY_SHARDS = {}
+DIRTY_CHANGES = 0
+FLUSH_WAKEUP = threading.Condition()
+FLUSHER = None
+# classes (by name) registered by lazy_load and not loaded yet
+PENDING_LOADS = {}
+# names of those of them being loaded by a warm-up thread
+WARMING_UP = set()
+# FILE_STATES[class name] -> (signatures of the snapshot files as last
+# read or written by this process, inode of the journal and offset up
+# to which it is applied to DATA)
+FILE_STATES = {}
+# SHARDS[class name][n] -> ids of the objects of shard file n, as an
+# insertion ordered set, built by the first sharded write
+SHARDS = {}
+# FILE_LOCKS[class name] -> [lock file, depth] of the file lock of the
+# class while this process holds it (see Base.file_lock)
+FILE_LOCKS = {}
+# MMAP_SNAPSHOTS[class name] -> Snapshot last mapped
+MMAP_SNAPSHOTS = {}
+# LISTENERS[class name][event] -> (callback, queued) pairs, replaced
+# (never changed) by listen and unlisten
+LISTENERS = {}
+EVENTS = ('save', 'remove', 'load')
+# (callback, argument) of the queued events, in order: join() waits
+# for their delivery
+EVENT_QUEUE = queue.Queue()
+NOTIFIER = None
+
+
+def write_atomically(file_path: str, text: str) -> tuple:
+    """ Replace the file with text through a temporary file of its own
+    (several processes may write it at once), and return the signature
+    of the new file
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=path.dirname(file_path) or '.',
+        prefix="{}.".format(path.basename(file_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            signature = file_signature(fd=f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return signature
+
+
+def file_signature(file_path: str = None, fd: int = None) -> tuple:
+    """ (inode, size, mtime) of a file, None if it does not exist: the
+    files are replaced atomically, so a new signature means new content
+    """
+    try:
+        st = os.fstat(fd) if fd is not None else os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
 
 
 class Base():
     """ Base class
     """
 
+    # no per-instance __dict__: subclasses declare their own __slots__
+    __slots__ = ('id', '_created_at', '_updated_at', '_json')
+    # store created_at/updated_at as int seconds since EPOCH (naive UTC),
+    # converted back to datetime on access
+    __epoch_timestamps__ = False
+    # keep the serialized form of each object until its next attribute
+    # assignment (one more dict per object, traded for the formatting)
+    __cache_json__ = True
+
+    # attributes with a secondary index, kept up to date by save,
+    # remove and load_from_file, and used by search
+    __indexes__ = ()
+    # attributes with a sorted index, used by the range, prefix and
+    # order_by searches; their values must be comparable to each other
+    __sorted_indexes__ = ()
+    # also write the binary snapshot of BASE_MMAP_SNAPSHOT
+    __mmap_snapshot__ = False
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
-        s_class = str(self.__class__.__name__)
-        if DATA.get(s_class) is None:
-            DATA[s_class] = {}
+        DATA.setdefault(str(self.__class__.__name__), {})
 
         self.id = kwargs.get('id', str(uuid.uuid4()))
         if kwargs.get('created_at') is not None:
@@ -35,6 +453,60 @@ class Base():
         else:
             self.updated_at = datetime.utcnow()
 
+    @property
+    def created_at(self) -> datetime:
+        """ Creation date
+        """
+        value = self._created_at
+        return EPOCH + timedelta(seconds=value) if type(value) is int \
+            else value
+
+    @created_at.setter
+    def created_at(self, value: datetime):
+        """ Setter of the creation date
+        """
+        self._created_at = self.compact_time(value)
+
+    @property
+    def updated_at(self) -> datetime:
+        """ Last update date
+        """
+        value = self._updated_at
+        return EPOCH + timedelta(seconds=value) if type(value) is int \
+            else value
+
+    @updated_at.setter
+    def updated_at(self, value: datetime):
+        """ Setter of the last update date
+        """
+        self._updated_at = self.compact_time(value)
+
+    @classmethod
+    def compact_time(cls, value: datetime):
+        """ Representation in which a timestamp is kept
+        """
+        if cls.__epoch_timestamps__ and type(value) is datetime:
+            return (value - EPOCH) // timedelta(seconds=1)
+        return value
+
+    @classmethod
+    def fields(cls) -> tuple:
+        """ Names of the attributes kept in slots, in definition order
+        """
+        fields = cls.__dict__.get('_fields')
+        if fields is None:
+            fields = []
+            for klass in reversed(cls.__mro__):
+                for name in klass.__dict__.get('__slots__', ()):
+                    if name in ('__dict__', '__weakref__', '_json'):
+                        continue
+                    # the timestamps are serialized under their public name
+                    fields.append(name[1:] if klass is Base and
+                                  name != 'id' else name)
+            fields = tuple(fields)
+            cls._fields = fields
+        return fields
+
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
         """
@@ -44,69 +516,783 @@ class Base():
             return False
         return (self.id == other.id)
 
+    def __setattr__(self, name: str, value):
+        """ Set an attribute, and drop the cached serialized form
+        """
+        object.__setattr__(self, name, value)
+        if name != '_json':
+            object.__setattr__(self, '_json', None)
+
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
-        result = {}
-        for key, value in self.__dict__.items():
-            if not for_serialization and key[0] == '_':
-                continue
-            if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
+        result = getattr(self, '_json', None)
+        if result is None:
+            result = {}
+            items = [(key, getattr(self, key, None))
+                     for key in self.fields()]
+            items.extend(getattr(self, '__dict__', {}).items())
+            for key, value in items:
+                if type(value) is datetime:
+                    result[key] = value.strftime(TIMESTAMP_FORMAT)
+                else:
+                    result[key] = value
+            if for_serialization:
+                # not kept: the file writes serialize every object, which
+                # would all carry one more dict
+                return result
+            # kept until the next attribute assignment: in-place changes
+            # of mutable attribute values are not seen
+            if self.__cache_json__:
+                object.__setattr__(self, '_json', result)
+        if for_serialization:
+            return dict(result)
+        return {key: value for key, value in result.items()
+                if key[0] != '_'}
+
+    @classmethod
+    def all_json(cls) -> List[dict]:
+        """ Public JSON forms of all objects, built once until the next
+        save, remove or load of the class
+        """
+        if sqlite_storage() is not None:
+            return [obj.to_json() for obj in cls.all()]
+        return [dict(obj_json) for obj_json in cls.cached_json()[0]]
+
+    @classmethod
+    def all_json_text(cls) -> str:
+        """ all_json encoded as a JSON array (compact, keys sorted),
+        encoded once until the next save, remove or load of the class
+        """
+        if sqlite_storage() is not None:
+            return json.dumps(cls.all_json(), separators=(',', ':'),
+                              sort_keys=True)
+        s_class = cls.__name__
+        text = JSON_TEXTS.get(s_class)
+        if text is None:
+            objs_json, version = cls.cached_json()
+            text = json.dumps(objs_json, separators=(',', ':'),
+                              sort_keys=True)
+            if JSON_VERSIONS.get(s_class, 0) == version:
+                JSON_TEXTS[s_class] = text
+        return text
+
+    @classmethod
+    def cached_json(cls) -> tuple:
+        """ (public JSON forms of all objects, shared: not to be changed,
+        version of the class they were built at)
+        """
+        s_class = cls.__name__
+        version = JSON_VERSIONS.get(s_class, 0)
+        objs_json = JSON_CACHE.get(s_class)
+        if objs_json is None:
+            objs_json = [obj.to_json()
+                         for obj in list(cls.objects().values())]
+            # not kept if a change invalidated it while it was built
+            if JSON_VERSIONS.get(s_class, 0) == version:
+                JSON_CACHE[s_class] = objs_json
+        return objs_json, version
+
+    @classmethod
+    def invalidate_json(cls):
+        """ Drop the cached JSON forms of all objects of the class
+        """
+        s_class = cls.__name__
+        JSON_VERSIONS[s_class] = JSON_VERSIONS.get(s_class, 0) + 1
+        JSON_CACHE.pop(s_class, None)
+        JSON_TEXTS.pop(s_class, None)
+
+    @classmethod
+    def from_json(cls, obj_json: dict,
+                  timestamps: dict = None) -> TypeVar('Base'):
+        """ Build an object from its serialized form, without going
+        through __init__ (unless instances have a __dict__ that __init__
+        may fill). timestamps memoizes the parsed dates of a bulk load
+        """
+        if cls.__dictoffset__:
+            return cls(**obj_json)
+        if timestamps is None:
+            timestamps = {}
+        obj = cls.__new__(cls)
+        fields = cls.fields()
+        # slots set directly: nothing is cached yet to invalidate
+        set_slot = object.__setattr__
+        set_slot(obj, '_json', None)
+        set_slot(obj, 'id', obj_json.get('id') or str(uuid.uuid4()))
+        for name in fields[1:3]:
+            value = obj_json.get(name)
+            if value is None:
+                value = cls.compact_time(datetime.utcnow())
             else:
-                result[key] = value
-        return result
+                parsed = timestamps.get(value)
+                if parsed is None:
+                    parsed = cls.compact_time(datetime.fromisoformat(value))
+                    timestamps[value] = parsed
+                value = parsed
+            set_slot(obj, '_' + name, value)
+        for name in fields[3:]:
+            set_slot(obj, name, obj_json.get(name))
+        return obj
 
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from file: the snapshot, then the changes
+        appended to the journal since it was written
+        """
+        if sqlite_storage() is not None:
+            return
+        s_class = cls.__name__
+        file_paths = cls.snapshot_paths()
+        objs = {}
+        # the file lock keeps the journal from being compacted between
+        # the snapshot and the journal reads, and its torn last line, if
+        # any, from being truncated while another process writes it
+        with cls.file_lock():
+            if s_class in DIRTY:
+                # written first, not lost to the reload
+                cls.flush()
+            # files of another BASE_SHARDS first: the current ones, if
+            # any, were written after them
+            stale_paths = cls.stale_snapshot_paths()
+            signatures = {}
+            timestamps = {}
+            for file_path, signature, items in cls.read_snapshots(
+                    stale_paths + file_paths):
+                signatures[file_path] = signature
+                for _, obj_json in items:
+                    obj = cls.from_json(obj_json, timestamps)
+                    objs[obj.id] = obj
+            journal_state = cls.replay_journal(objs=objs)
+            # readers see the previous objects until the new ones are
+            # complete; the indexes first, see search
+            cls.reindex(objs)
+            DATA[s_class] = objs
+            cls.invalidate_json()
+            FILE_STATES[s_class] = (tuple(signatures.get(file_path)
+                                          for file_path in file_paths),) + \
+                journal_state
+            PENDING_LOADS.pop(s_class, None)
+            WARMING_UP.discard(s_class)
+            if stale_paths:
+                cls.write_to_file()
+            cls.notify('load', [cls])
+
+    @classmethod
+    def snapshot_paths(cls) -> List[str]:
+        """ Files of the snapshot of the class, one per shard
+        """
+        count = shard_count()
+        if count == 1:
+            return [".db_{}.json".format(cls.__name__)]
+        return [".db_{}.{}-of-{}.json".format(cls.__name__, n, count)
+                for n in range(count)]
+
+    @classmethod
+    def stale_snapshot_paths(cls) -> List[str]:
+        """ Snapshot files of the class written with another BASE_SHARDS
+        """
+        file_paths = glob(".db_{}.*-of-*.json".format(cls.__name__))
+        file_paths.append(".db_{}.json".format(cls.__name__))
+        current = set(cls.snapshot_paths())
+        return sorted(file_path for file_path in file_paths
+                      if file_path not in current and path.exists(file_path))
+
+    @classmethod
+    def read_snapshots(cls, file_paths: List[str]) -> Iterator[tuple]:
+        """ (path, signature, (id, object JSON) pairs) of each existing
+        snapshot file: the shard files are parsed by a pool of threads,
+        unless streamed
+        """
+        file_paths = [file_path for file_path in file_paths
+                      if path.exists(file_path)]
+        if len(file_paths) > 1 and not stream_load():
+            workers = min(len(file_paths), load_workers())
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                yield from pool.map(read_snapshot, file_paths)
+            return
+        for file_path in file_paths:
+            with open(file_path, 'r') as f:
+                signature = file_signature(fd=f.fileno())
+                if stream_load():
+                    items = iter_json_object(f)
+                else:
+                    items = json.load(f).items()
+                yield file_path, signature, items
+
+    @classmethod
+    def shards(cls) -> List[dict]:
+        """ Ids of the objects of each shard file (see SHARDS)
+        """
+        count = shard_count()
+        shards = SHARDS.get(cls.__name__)
+        if shards is None or len(shards) != count:
+            shards = [{} for _ in range(count)]
+            for obj_id in list(cls.objects()):
+                shards[shard_of(obj_id, count)][obj_id] = None
+            SHARDS[cls.__name__] = shards
+        return shards
+
+    @classmethod
+    def refresh(cls) -> bool:
+        """ Bring DATA up to date with the files written by other
+        processes since the last load: reload them if the snapshot
+        changed, else apply only the journal changes past the last
+        offset. Returns whether anything was read
+        """
+        s_class = cls.__name__
+        if sqlite_storage() is not None or s_class in DIRTY:
+            # the database is always current; a dirty class holds
+            # changes not written yet, that a reload would lose
+            return False
+        # compared without WRITE_LOCK, which the writers of every class
+        # hold through their file writes: only a reload or a replay
+        # waits for them
+        if s_class not in PENDING_LOADS and \
+                cls.file_changes(FILE_STATES.get(s_class)) is None:
+            return False
+        with WRITE_LOCK:
+            # may have been brought up to date by another thread meanwhile
+            return cls.catch_up()
+
+    @classmethod
+    def catch_up(cls) -> bool:
+        """ Apply to DATA (holding WRITE_LOCK) what the files hold that it
+        has not: reload them or replay the new journal changes, see
+        file_changes. Returns whether anything was read
+        """
+        s_class = cls.__name__
+        state = FILE_STATES.get(s_class)
+        change = 'load' if s_class in PENDING_LOADS \
+            else cls.file_changes(state)
+        if change is None:
+            return False
+        if change == 'load':
+            cls.load_from_file()
+        else:
+            FILE_STATES[s_class] = (state[0],) + \
+                cls.replay_journal(state[2], incremental=True)
+        return True
+
+    @classmethod
+    @contextmanager
+    def file_lock(cls) -> Iterator[None]:
+        """ Hold WRITE_LOCK and the lock, shared by all processes, on the
+        files of the class (flock of .db_<Class>.lock, reentrant): taken
+        by the journal appends, the loads and the snapshot writes, so
+        that no change is appended between a compaction replaying the
+        journal and removing it
+        """
+        s_class = cls.__name__
+        with WRITE_LOCK:
+            lock = FILE_LOCKS.get(s_class)
+            if lock is None:
+                f = open(".db_{}.lock".format(s_class), 'a')
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                except BaseException:
+                    f.close()
+                    raise
+                lock = FILE_LOCKS[s_class] = [f, 0]
+            lock[1] += 1
+            try:
+                yield
+            finally:
+                lock[1] -= 1
+                if not lock[1]:
+                    del FILE_LOCKS[s_class]
+                    # closing the file releases the flock
+                    lock[0].close()
+
+    @classmethod
+    def file_changes(cls, state: tuple) -> str:
+        """ What brings DATA up to date with the files, given the class
+        FILE_STATES: None when it is, 'replay' for the journal changes
+        past the offset, 'load' when the snapshot changed or the journal
+        was compacted or replaced
+        """
+        if state is None:
+            return 'load'
+        signatures, journal_inode, offset = state
+        if tuple(file_signature(file_path) for file_path
+                 in cls.snapshot_paths()) != signatures:
+            return 'load'
+        journal = file_signature(".db_{}.journal".format(cls.__name__))
+        if journal is None and journal_inode is None:
+            return None
+        if journal is None or journal[0] != journal_inode or \
+                journal[1] < offset:
+            return 'load'
+        return None if journal[1] == offset else 'replay'
+
+    @classmethod
+    def lazy_load(cls, warm_up: bool = False):
+        """ Defer load_from_file to the first access to the objects or,
+        with warm_up, to a background thread; meanwhile the accesses
+        wait for the load to complete
+        """
+        if sqlite_storage() is not None:
+            return
+        PENDING_LOADS[cls.__name__] = cls
+        if warm_up:
+            WARMING_UP.add(cls.__name__)
+            threading.Thread(target=cls.objects, daemon=True,
+                             name="{}-warm-up".format(cls.__name__)).start()
+
+    @classmethod
+    def objects(cls) -> dict:
+        """ DATA of the class, loaded first if lazy_load deferred it
+        """
+        s_class = cls.__name__
+        if s_class in PENDING_LOADS:
+            with WRITE_LOCK:
+                if s_class in PENDING_LOADS:
+                    cls.load_from_file()
+        return DATA[s_class]
+
+    @classmethod
+    def is_ready(cls) -> bool:
+        """ Whether the class (every class when called on Base) serves
+        requests without making them wait for a warm-up: once loaded,
+        when lazy_load deferred the load to the first use, or while its
+        mmap snapshot answers instead
+        """
+        if cls is Base:
+            return all(pending.is_ready()
+                       for pending in list(PENDING_LOADS.values()))
+        if cls.__name__ not in WARMING_UP:
+            return True
+        return cls.mmap_snapshot() is not None
+
+    @classmethod
+    def replay_journal(cls, offset: int = 0, incremental: bool = False,
+                       objs: dict = None) -> tuple:
+        """ Apply to DATA (or objs) the changes recorded in the journal
+        from offset on (and, when incremental, to the indexes). Returns
+        the inode of the journal and the offset reached
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
+        if objs is None:
+            objs = DATA[s_class]
+        journal_path = ".db_{}.journal".format(s_class)
+        try:
+            f = open(journal_path, 'rb+')
+        except FileNotFoundError:
+            return None, 0
+
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            f.seek(offset)
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("unterminated change")
+                    entry = json.loads(line)
+                except ValueError:
+                    # a change torn by a crash: drop it so that the next
+                    # ones are not appended to a broken line. Another
+                    # process may still be writing it: left to the loads
+                    if not incremental:
+                        f.truncate(offset)
+                    break
+                offset += len(line)
+                if entry['op'] == 'save':
+                    obj = cls.from_json(entry['obj'])
+                    objs[obj.id] = obj
+                    if incremental:
+                        cls.index(obj)
+                        cls.notify('save', [obj])
+                else:
+                    obj = objs.pop(entry['id'], None)
+                    if incremental and obj is not None:
+                        cls.unindex(obj)
+                        cls.notify('remove', [obj.id])
+        if incremental:
+            cls.invalidate_json()
+        return inode, offset
+
+    @classmethod
+    def append_to_journal(cls, *entries: dict):
+        """ Record changes in the journal, in one write, and compact it
+        into the snapshot once it outgrows BASE_JOURNAL_MAX_BYTES
+        """
+        s_class = cls.__name__
+        journal_path = ".db_{}.journal".format(s_class)
+        with cls.file_lock():
+            with open(journal_path, 'a') as f:
+                start = f.tell()
+                f.write(''.join(json.dumps(entry) + '\n'
+                                for entry in entries))
+                size = f.tell()
+                inode = os.fstat(f.fileno()).st_ino
+            # our own change is already in DATA: skip it on refresh,
+            # unless other processes appended since the last one
+            state = FILE_STATES.get(s_class)
+            if state is not None and (state[1:] == (inode, start) or
+                                      state[1] is None and start == 0):
+                FILE_STATES[s_class] = (state[0], inode, size)
+        if size > journal_max_bytes():
+            cls.save_to_file()
+
+    @classmethod
+    def save_to_file(cls, obj_ids: Iterable[str] = None):
+        """ Save all objects to file, which also empties the journal
+        (in write-behind mode, mark the class to be saved soon). When
+        the snapshot is sharded, obj_ids limits the write to the shards
+        of these (changed) objects
+        """
+        if sqlite_storage() is not None:
             return
+        shards = None
+        count = shard_count()
+        if obj_ids is not None and count > 1:
+            shards = {shard_of(obj_id, count) for obj_id in obj_ids}
+        if write_behind():
+            cls.mark_dirty(shards)
+        else:
+            cls.write_to_file(shards)
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def write_to_file(cls, shards: Iterable[int] = None):
+        """ Write the snapshot of all objects, atomically, and empty the
+        journal; or rewrite only the given shard files
+        """
+        s_class = cls.__name__
+        journal_path = ".db_{}.journal".format(s_class)
+        with cls.file_lock():
+            if storage_mode() == 'journal':
+                # the changes other processes appended since the last
+                # replay go into the snapshot, not away with the journal
+                cls.catch_up()
+            objs = cls.objects()
+            file_paths = cls.snapshot_paths()
+            state = FILE_STATES.get(s_class)
+            if len(file_paths) == 1:
+                shards = None
+            if shards is None:
+                shards = range(len(file_paths))
+                signatures = [None] * len(file_paths)
+            elif state is not None and len(state[0]) == len(file_paths):
+                signatures = list(state[0])
+            else:
+                # the other files are unknown: the next refresh reloads
+                signatures = [None] * len(file_paths)
+                state = None
+
+            for n in sorted(set(shards)):
+                if len(file_paths) == 1:
+                    items = list(objs.items())
+                else:
+                    items = [(obj_id, objs[obj_id])
+                             for obj_id in list(cls.shards()[n])
+                             if obj_id in objs]
+                objs_json = {}
+                for obj_id, obj in items:
+                    objs_json[obj_id] = obj.to_json(True)
+                # the snapshot must be complete before the journal goes
+                # away; dumps, unlike dump, runs the C encoder
+                signatures[n] = write_atomically(file_paths[n],
+                                                 json.dumps(objs_json))
+            cls.write_mmap_snapshot()
+
+            if len(shards) < len(file_paths):
+                if state is not None:
+                    FILE_STATES[s_class] = (tuple(signatures),) + state[1:]
+                return
+            for stale_path in cls.stale_snapshot_paths():
+                os.remove(stale_path)
+            if path.exists(journal_path):
+                os.remove(journal_path)
+            FILE_STATES[s_class] = (tuple(signatures), None, 0)
 
     @classmethod
-    def save_to_file(cls):
-        """ Save all objects to file
+    def write_mmap_snapshot(cls):
+        """ Write the binary snapshot of all objects, or remove the one
+        BASE_MMAP_SNAPSHOT no longer keeps up to date
+        """
+        snapshot_path = ".db_{}.snapshot".format(cls.__name__)
+        if cls.__mmap_snapshot__ and mmap_snapshots() and \
+                storage_mode() == 'json':
+            write_snapshot(snapshot_path, cls.fields(),
+                           ('id',) + cls.__indexes__,
+                           (obj.to_json(True)
+                            for obj in list(cls.objects().values())))
+        elif path.exists(snapshot_path):
+            os.remove(snapshot_path)
+
+    @classmethod
+    def mmap_snapshot(cls) -> Snapshot:
+        """ Binary snapshot to read the objects from, as long as the class
+        is not loaded, else None
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        if not cls.__mmap_snapshot__ or s_class not in PENDING_LOADS or \
+                not mmap_snapshots() or storage_mode() != 'json':
+            # the journal holds changes the snapshot has not
+            return None
+        snapshot_path = ".db_{}.snapshot".format(s_class)
+        signature = file_signature(snapshot_path)
+        if signature is None:
+            return None
+        snapshot = MMAP_SNAPSHOTS.get(s_class)
+        if snapshot is None or snapshot.signature != signature:
+            try:
+                snapshot = Snapshot(snapshot_path)
+            except (OSError, ValueError):
+                return None
+            # the previous mapping is unmapped once no reader holds it
+            MMAP_SNAPSHOTS[s_class] = snapshot
+        return snapshot
+
+    @classmethod
+    def mark_dirty(cls, shards: Iterable[int] = None):
+        """ Schedule the write of the class file (or of the given shard
+        files) by the flusher thread
+        """
+        global DIRTY_CHANGES, FLUSHER
+        with FLUSH_WAKEUP:
+            s_class = cls.__name__
+            if s_class not in DIRTY:
+                DIRTY_SHARDS[s_class] = set()
+            if shards is None or DIRTY_SHARDS[s_class] is None:
+                DIRTY_SHARDS[s_class] = None
+            else:
+                DIRTY_SHARDS[s_class].update(shards)
+            DIRTY[s_class] = cls
+            DIRTY_CHANGES += 1
+            if FLUSHER is None:
+                FLUSHER = threading.Thread(target=flush_forever,
+                                           name="base-flusher", daemon=True)
+                FLUSHER.start()
+            if DIRTY_CHANGES >= int(getenv('BASE_FLUSH_CHANGES', 1000)):
+                FLUSH_WAKEUP.notify()
+
+    @classmethod
+    def flush(cls):
+        """ Write now the pending changes of the class, or of every class
+        when called on Base
+        """
+        global DIRTY_CHANGES
+        # the changes are taken and written under the same WRITE_LOCK:
+        # a flush finding nothing dirty (the one at exit, when the
+        # flusher thread is about to be killed) waits for the write of
+        # the changes another flush has already taken
+        with WRITE_LOCK:
+            with FLUSH_WAKEUP:
+                if cls is Base:
+                    pending = [(dirty_cls, DIRTY_SHARDS.pop(s_class))
+                               for s_class, dirty_cls in DIRTY.items()]
+                    DIRTY.clear()
+                    DIRTY_CHANGES = 0
+                else:
+                    pending = [(DIRTY.pop(cls.__name__),
+                                DIRTY_SHARDS.pop(cls.__name__))] \
+                        if cls.__name__ in DIRTY else []
+            for n, (dirty_cls, shards) in enumerate(pending):
+                try:
+                    dirty_cls.write_to_file(shards)
+                except Exception:
+                    for failed_cls, failed_shards in pending[n:]:
+                        failed_cls.mark_dirty(failed_shards)
+                    raise
+
+    @classmethod
+    def listen(cls, event: str, callback: Callable,
+               queued: bool = False) -> Callable:
+        """ Call callback on each event of the class: 'save' with the
+        saved object, 'remove' with the removed id, 'load' with the class
+        once its objects are (re)loaded from file. Changes read by
+        refresh from other processes journals are events too.
+        Synchronous callbacks run in the writing thread, holding
+        WRITE_LOCK, and their errors reach the writer (the change being
+        already stored); queued ones run in order on a background thread
+        """
+        if event not in EVENTS:
+            raise ValueError("unknown event {}".format(event))
+        with WRITE_LOCK:
+            listeners = dict(LISTENERS.get(cls.__name__, {}))
+            listeners[event] = listeners.get(event, ()) + \
+                ((callback, queued),)
+            LISTENERS[cls.__name__] = listeners
+        return callback
+
+    @classmethod
+    def unlisten(cls, event: str, callback: Callable):
+        """ Stop calling callback on the event of the class
+        """
+        with WRITE_LOCK:
+            listeners = dict(LISTENERS.get(cls.__name__, {}))
+            listeners[event] = tuple(
+                listener for listener in listeners.get(event, ())
+                if listener[0] != callback)
+            LISTENERS[cls.__name__] = listeners
+
+    @classmethod
+    def on_save(cls, callback: Callable, queued: bool = False) -> Callable:
+        """ listen to the saves of the class (usable as a decorator)
+        """
+        return cls.listen('save', callback, queued)
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def on_remove(cls, callback: Callable,
+                  queued: bool = False) -> Callable:
+        """ listen to the removals of the class (usable as a decorator)
+        """
+        return cls.listen('remove', callback, queued)
+
+    @classmethod
+    def on_load(cls, callback: Callable, queued: bool = False) -> Callable:
+        """ listen to the loads of the class (usable as a decorator)
+        """
+        return cls.listen('load', callback, queued)
+
+    @classmethod
+    def notify(cls, event: str, args: list):
+        """ Deliver the event to its listeners, once per argument
+        """
+        global NOTIFIER
+        listeners = LISTENERS.get(cls.__name__, {}).get(event)
+        if not listeners or not args:
+            return
+        for callback, queued in listeners:
+            if not queued:
+                for arg in args:
+                    callback(arg)
+                continue
+            with WRITE_LOCK:
+                if NOTIFIER is None:
+                    NOTIFIER = threading.Thread(target=notify_forever,
+                                                name="base-notifier",
+                                                daemon=True)
+                    NOTIFIER.start()
+            for arg in args:
+                EVENT_QUEUE.put((callback, arg))
+
+    @classmethod
+    def publish(cls, saved: List[TypeVar('Base')] = (),
+                removed: List[str] = ()):
+        """ Record the changes made by this process in the change stream,
+        then notify the listeners
+        """
+        if change_stream_path() is not None:
+            change = {'class': cls.__name__, 'pid': os.getpid()}
+            append_changes(
+                [dict(change, op='save', obj=obj.to_json(True))
+                 for obj in saved] +
+                [dict(change, op='remove', id=obj_id) for obj_id in removed])
+        cls.notify('save', saved)
+        cls.notify('remove', removed)
 
     def save(self):
         """ Save current object
         """
-        s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        storage = sqlite_storage()
+        with WRITE_LOCK:
+            if storage is not None:
+                storage.save(self)
+                self.__class__.publish(saved=[self])
+                return
+            self.__class__.objects()[self.id] = self
+            self.__class__.index(self)
+            self.__class__.invalidate_json()
+            if storage_mode() == 'journal':
+                self.__class__.append_to_journal({'op': 'save',
+                                                  'obj': self.to_json(True)})
+            else:
+                self.__class__.save_to_file((self.id,))
+            self.__class__.publish(saved=[self])
 
     def remove(self):
         """ Remove object
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        storage = sqlite_storage()
+        with WRITE_LOCK:
+            if storage is not None:
+                if storage.remove(self.__class__, self.id):
+                    self.__class__.publish(removed=[self.id])
+                return
+            objs = self.__class__.objects()
+            if objs.pop(self.id, None) is None:
+                return
+            self.__class__.unindex(self)
+            self.__class__.invalidate_json()
+            if storage_mode() == 'journal':
+                self.__class__.append_to_journal({'op': 'remove',
+                                                  'id': self.id})
+            else:
+                self.__class__.save_to_file((self.id,))
+            self.__class__.publish(removed=[self.id])
+
+    @classmethod
+    def save_many(cls, objs: Iterable[TypeVar('Base')]):
+        """ Save objects of the class, persisted all at once
+        """
+        objs = list(objs)
+        if not objs:
+            return
+        now = datetime.utcnow()
+        for obj in objs:
+            obj.updated_at = now
+        storage = sqlite_storage()
+        with WRITE_LOCK:
+            if storage is not None:
+                storage.save_many(cls, objs)
+                cls.publish(saved=objs)
+                return
+            stored = cls.objects()
+            for obj in objs:
+                stored[obj.id] = obj
+            cls.index_many(objs)
+            cls.invalidate_json()
+            if storage_mode() == 'journal':
+                cls.append_to_journal(*({'op': 'save',
+                                         'obj': obj.to_json(True)}
+                                        for obj in objs))
+            else:
+                cls.save_to_file(obj.id for obj in objs)
+            cls.publish(saved=objs)
+
+    @classmethod
+    def remove_many(cls, ids: Iterable[str]) -> int:
+        """ Remove objects of the class by id, persisted all at once.
+        Returns the number of objects removed
+        """
+        ids = list(ids)
+        storage = sqlite_storage()
+        with WRITE_LOCK:
+            if storage is not None:
+                removed_ids = storage.remove_many(cls, ids)
+                cls.publish(removed=removed_ids)
+                return len(removed_ids)
+            stored = cls.objects()
+            removed = []
+            for obj_id in ids:
+                obj = stored.pop(obj_id, None)
+                if obj is not None:
+                    removed.append(obj)
+            if not removed:
+                return 0
+            cls.unindex_many(removed)
+            cls.invalidate_json()
+            if storage_mode() == 'journal':
+                cls.append_to_journal(*({'op': 'remove', 'id': obj.id}
+                                        for obj in removed))
+            else:
+                cls.save_to_file(obj.id for obj in removed)
+            cls.publish(removed=[obj.id for obj in removed])
+        return len(removed)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
-        s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        storage = sqlite_storage()
+        if storage is not None:
+            return storage.count(cls)
+        snapshot = cls.mmap_snapshot()
+        if snapshot is not None:
+            return len(snapshot)
+        return len(cls.objects().keys())
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -118,20 +1304,275 @@ class Base():
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
+        storage = sqlite_storage()
+        if storage is not None:
+            return storage.get(cls, id)
+        snapshot = cls.mmap_snapshot()
+        if snapshot is not None:
+            rows = snapshot.find('id', id)
+            return cls.from_json(rows[0]) if rows else None
+        return cls.objects().get(id)
+
+    @classmethod
+    def reindex(cls, objs: dict = None):
+        """ Rebuild the secondary indexes from the stored objects (or
+        objs), swapped in once complete
+        """
         s_class = cls.__name__
-        return DATA[s_class].get(id)
+        if objs is None:
+            objs = DATA.get(s_class, {})
+        attrs = cls.__indexes__ + cls.__sorted_indexes__
+        indexes = {attr: {} for attr in cls.__indexes__}
+        entries = {attr: [] for attr in cls.__sorted_indexes__}
+        indexed = {}
+        for obj in list(objs.values()):
+            values = tuple(getattr(obj, attr, None) for attr in attrs)
+            for attr, value in zip(cls.__indexes__, values):
+                index_add(indexes[attr], value, obj.id)
+            for attr, value in zip(cls.__sorted_indexes__,
+                                   values[len(cls.__indexes__):]):
+                if value is not None:
+                    entries[attr].append((value, obj.id))
+            indexed[obj.id] = values
+        # sorted once instead of one insertion per object
+        sorted_indexes = {}
+        for attr, pairs in entries.items():
+            pairs.sort(key=itemgetter(0))
+            sorted_indexes[attr] = SortedIndex(pairs)
+        with WRITE_LOCK:
+            INDEXES[s_class] = indexes
+            SORTED_INDEXES[s_class] = sorted_indexes
+            INDEXED[s_class] = indexed
+            SHARDS.pop(s_class, None)
+
+    @classmethod
+    def index(cls, obj: TypeVar('Base')):
+        """ Index (again) one object under its current attribute values
+        """
+        cls.index_many((obj,))
 
     @classmethod
-    def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
-        """ Search all objects with matching attributes
+    def index_many(cls, objs: Iterable[TypeVar('Base')]):
+        """ Index (again) objects under their current attribute values
         """
+        objs = list({obj.id: obj for obj in objs}.values())
+        shards = SHARDS.get(cls.__name__)
+        if shards is not None:
+            for obj in objs:
+                shards[shard_of(obj.id, len(shards))][obj.id] = None
+        if not cls.__indexes__ and not cls.__sorted_indexes__:
+            return
         s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
-            for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+        with WRITE_LOCK:
+            if s_class not in INDEXES:
+                cls.reindex()
+            removed = cls.unindex_values(objs)
+            attrs = cls.__indexes__ + cls.__sorted_indexes__
+            added = {attr: [] for attr in cls.__sorted_indexes__}
+            for obj in objs:
+                values = tuple(getattr(obj, attr, None) for attr in attrs)
+                for attr, value in zip(cls.__indexes__, values):
+                    index_add(INDEXES[s_class][attr], value, obj.id)
+                for attr, value in zip(cls.__sorted_indexes__,
+                                       values[len(cls.__indexes__):]):
+                    # None, which sorts with nothing, matches no range
+                    if value is not None:
+                        added[attr].append((value, obj.id))
+                INDEXED[s_class][obj.id] = values
+            for attr in cls.__sorted_indexes__:
+                cls.update_sorted_index(attr, added[attr], removed[attr])
+
+    @classmethod
+    def unindex(cls, obj: TypeVar('Base')):
+        """ Remove one object from the secondary indexes
+        """
+        cls.unindex_many((obj,))
+
+    @classmethod
+    def unindex_many(cls, objs: Iterable[TypeVar('Base')]):
+        """ Remove objects from the secondary indexes
+        """
+        objs = list(objs)
+        shards = SHARDS.get(cls.__name__)
+        if shards is not None:
+            for obj in objs:
+                shards[shard_of(obj.id, len(shards))].pop(obj.id, None)
+        with WRITE_LOCK:
+            removed = cls.unindex_values(objs)
+            for attr, pairs in removed.items():
+                cls.update_sorted_index(attr, (), pairs)
+
+    @classmethod
+    def unindex_values(cls, objs: Iterable[TypeVar('Base')]) -> dict:
+        """ Remove objects from the hash indexes, and return, by sorted
+        index, the (value, id) entries left to remove from it
+        """
+        s_class = cls.__name__
+        removed = {attr: [] for attr in cls.__sorted_indexes__}
+        for obj in objs:
+            values = INDEXED.get(s_class, {}).pop(obj.id, None)
+            if values is None:
+                continue
+            for attr, value in zip(cls.__indexes__, values):
+                index_discard(INDEXES[s_class][attr], value, obj.id)
+            for attr, value in zip(cls.__sorted_indexes__,
+                                   values[len(cls.__indexes__):]):
+                if value is not None:
+                    removed[attr].append((value, obj.id))
+        return removed
+
+    @classmethod
+    def update_sorted_index(cls, attr: str, added: List[tuple],
+                            removed: List[tuple]):
+        """ Replace the sorted index of attr by one without the removed
+        and with the added (value, id) entries: the index readers may be
+        walking is never changed
+        """
+        if not added and not removed:
+            return
+        sorted_indexes = SORTED_INDEXES[cls.__name__]
+        sorted_indexes[attr] = sorted_indexes[attr].changed(added, removed)
+
+    @classmethod
+    def sorted_ids(cls, attr: str, bounds: List[tuple],
+                   reverse: bool = False) -> Iterator[str]:
+        """ Ids of the objects whose attr is within the (lookup, argument)
+        bounds, in the order of the sorted index of attr (or the reverse),
+        read as they are consumed
+        """
+        index = SORTED_INDEXES[cls.__name__][attr]
+        lo, hi = (0, 0), index.end()
+        for lookup, arg in bounds:
+            if lookup == 'gt':
+                lo = max(lo, index.upper(arg))
+            elif lookup == 'gte':
+                lo = max(lo, index.lower(arg))
+            elif lookup == 'lt':
+                hi = min(hi, index.lower(arg))
+            elif lookup == 'lte':
+                hi = min(hi, index.upper(arg))
+            elif lookup == 'startswith':
+                if type(arg) is not str or \
+                        index.maxes and type(index.maxes[0]) is not str:
+                    # only strings sort by prefix: left to matches
+                    continue
+                lo = max(lo, index.lower(arg))
+                end = prefix_end(arg)
+                if end is not None:
+                    hi = min(hi, index.lower(end))
+        return index.walk(lo, hi, reverse)
+
+    @classmethod
+    def search(cls, attributes: dict = {}, order_by: str = None,
+               limit: int = None) -> List[TypeVar('Base')]:
+        """ Search all objects with matching attributes: the keys are
+        attribute names, for equality, or attr__lookup (see LOOKUPS).
+        order_by names an attribute, prefixed by '-' for the descending
+        order; limit caps the number of objects returned
+        """
+        storage = sqlite_storage()
+        if storage is not None:
+            return storage.search(cls, attributes, order_by, limit)
+        snapshot = cls.mmap_snapshot()
+        if snapshot is not None and order_by is None:
+            conditions = parse_conditions(attributes)
+            for k, lookup, v in conditions:
+                # the snapshot holds the values as serialized
+                if lookup == 'exact' and k in snapshot.keys and \
+                        type(v) in (str, int, float):
+                    objs = (cls.from_json(row) for row in snapshot.find(k, v))
+                    return list(islice((obj for obj in objs
+                                        if matches(obj, conditions)), limit))
+        while True:
+            objs = cls.objects()
+            result = cls.search_objects(objs, attributes, order_by, limit)
+            # a load swaps the indexes in, then the objects: indexes read
+            # for the previous objects may be the new ones
+            if DATA[cls.__name__] is objs:
+                return result
+
+    @classmethod
+    def search_objects(cls, objs: dict, attributes: dict,
+                       order_by: str = None,
+                       limit: int = None) -> List[TypeVar('Base')]:
+        """ Search in the objs of the class (see search)
+        """
+        s_class = cls.__name__
+        conditions = parse_conditions(attributes)
+        candidates = None
+        for k, lookup, v in conditions:
+            index = INDEXES.get(s_class, {}).get(k)
+            if index is None or lookup != 'exact':
+                continue
+            try:
+                ids = index.get(v, ())
+            except TypeError:
+                continue
+            if type(ids) is str:
+                ids = (ids,)
+            candidates = [objs.get(obj_id) for obj_id in list(ids)]
+            break
+
+        # else walk a sorted index: on the order_by attribute if it
+        # has one, the objects then come already ordered
+        sorted_indexes = SORTED_INDEXES.get(s_class, {})
+        order_attr = order_by.lstrip('-') if order_by else None
+        ranges = [k for k, lookup, _ in conditions
+                  if lookup != 'exact' and k in sorted_indexes]
+        ordered = False
+        if candidates is None and (ranges or order_attr in sorted_indexes):
+            attr = order_attr if order_attr in sorted_indexes and \
+                (order_attr in ranges or not ranges) else ranges[0]
+            ordered = attr == order_attr
+            ids = cls.sorted_ids(attr, [(lookup, v)
+                                        for k, lookup, v in conditions
+                                        if k == attr and lookup != 'exact'],
+                                 ordered and order_by[0] == '-')
+            candidates = (objs.get(obj_id) for obj_id in ids)
+            if attr not in ranges:
+                def unindexed():
+                    """ Objects without a value: not in the index, last
+                    """
+                    for obj in list(objs.values()):
+                        if getattr(obj, attr, None) is None:
+                            yield obj
+                candidates = chain(candidates, unindexed())
+        if candidates is None:
+            candidates = list(objs.values())
+
+        # ids of removed objects may still be read from the indexes
+        result = (obj for obj in candidates
+                  if obj is not None and matches(obj, conditions))
+        if order_by and not ordered:
+            result = sort_objects(result, order_by)
+        return list(islice(result, limit))
+
+
+def flush_forever():
+    """ Body of the write-behind flusher thread
+    """
+    while True:
+        with FLUSH_WAKEUP:
+            FLUSH_WAKEUP.wait(float(getenv('BASE_FLUSH_INTERVAL', 1)))
+        try:
+            Base.flush()
+        except Exception:
+            # the classes stay dirty: retried at the next round
+            pass
+
+
+def notify_forever():
+    """ Body of the thread delivering the queued events
+    """
+    while True:
+        callback, arg = EVENT_QUEUE.get()
+        try:
+            callback(arg)
+        except Exception:
+            # a failing listener must not stop the others
+            pass
+        finally:
+            EVENT_QUEUE.task_done()
+
+
+atexit.register(Base.flush)
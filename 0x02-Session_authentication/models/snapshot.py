@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+""" Binary snapshot of the Base models, read through mmap
+
+Layout, in native byte order, with every section aligned on 8 bytes:
+- header: magic, version, size of the metadata
+- metadata (JSON): fields, record count, offsets of the sections
+- record table: for each record and field, (heap offset, length) as
+  two unsigned 32 bits ints; the length is NONE for None, and has the
+  JSON flag when the value is JSON encoded instead of a UTF-8 string
+- one hash table per key field: record number + 1 (0 when empty) at
+  crc32(value) modulo the table size, then the next free slots
+- string heap
+"""
+from array import array
+from typing import Iterable, List
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+
+MAGIC = b'BSNP'
+VERSION = 1
+HEADER = struct.Struct('=4sII')
+NONE = 0xFFFFFFFF
+JSON = 0x80000000
+
+
+def key_bytes(value) -> bytes:
+    """ Bytes of a key value, as hashed and compared
+    """
+    if type(value) is str:
+        return value.encode()
+    return json.dumps(value).encode()
+
+
+def align(size: int) -> int:
+    """ size rounded up to a multiple of 8
+    """
+    return (size + 7) & ~7
+
+
+def write_snapshot(file_path: str, fields: tuple, keys: tuple,
+                   rows: Iterable[dict]):
+    """ Write atomically the snapshot of the rows (serialized objects),
+    with a hash index on each of the keys fields
+    """
+    heap = bytearray()
+    table = array('I')
+    key_values = {key: [] for key in keys}
+    count = 0
+    for row in rows:
+        for field in fields:
+            value = row.get(field)
+            if value is None:
+                table.extend((0, NONE))
+                continue
+            if type(value) is str:
+                data, flag = value.encode(), 0
+            else:
+                data, flag = json.dumps(value).encode(), JSON
+            table.extend((len(heap), len(data) | flag))
+            heap += data
+        for key in keys:
+            key_values[key].append(row.get(key))
+        count += 1
+
+    hash_tables = {}
+    size = 1
+    while size < 2 * count:
+        size *= 2
+    for key, values in key_values.items():
+        slots = array('I', bytes(4 * size))
+        for n, value in enumerate(values):
+            if value is None:
+                continue
+            slot = zlib.crc32(key_bytes(value)) & (size - 1)
+            while slots[slot]:
+                slot = (slot + 1) & (size - 1)
+            slots[slot] = n + 1
+        hash_tables[key] = slots
+
+    # the metadata holds offsets that depend on its own size: computed
+    # with a large enough size, then padded to it
+    meta = {'fields': list(fields), 'count': count}
+    meta_size = align(len(json.dumps(meta)) + 64 * 2 +
+                      sum(len(json.dumps(key)) + 64 for key in keys))
+    offset = align(HEADER.size) + meta_size
+    meta['table'] = offset
+    offset = align(offset + table.itemsize * len(table))
+    meta['keys'] = {}
+    for key, slots in hash_tables.items():
+        meta['keys'][key] = [offset, len(slots)]
+        offset = align(offset + slots.itemsize * len(slots))
+    meta['heap'] = offset
+    meta_json = json.dumps(meta).encode().ljust(meta_size)
+
+    # a temporary file of its own: several processes may write at once
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path) or '.',
+        prefix="{}.".format(os.path.basename(file_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, meta_size).ljust(
+                align(HEADER.size), b'\0'))
+            f.write(meta_json)
+            for section in [table] + list(hash_tables.values()):
+                f.write(section.tobytes())
+                f.write(bytes(align(f.tell()) - f.tell()))
+            f.write(heap)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class Snapshot():
+    """ Read-only view of a snapshot file: the pages are shared by all
+    the processes mapping it, and records are decoded one at a time
+    """
+
+    def __init__(self, file_path: str):
+        """ Map the snapshot file file_path
+        """
+        with open(file_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.signature = st.st_ino, st.st_size, st.st_mtime_ns
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, meta_size = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a version {} snapshot".format(VERSION))
+        start = align(HEADER.size)
+        meta = json.loads(self.mmap[start:start + meta_size])
+        self.fields = tuple(meta['fields'])
+        self.count = meta['count']
+        self.heap = meta['heap']
+        view = memoryview(self.mmap)
+        table_size = 8 * self.count * len(self.fields)
+        self.table = view[meta['table']:meta['table'] + table_size] \
+            .cast('I')
+        self.keys = {key: view[offset:offset + 4 * size].cast('I')
+                     for key, (offset, size) in meta['keys'].items()}
+
+    def __len__(self) -> int:
+        """ Number of records
+        """
+        return self.count
+
+    def record(self, n: int) -> dict:
+        """ Fields of record n
+        """
+        row = {}
+        base = 2 * n * len(self.fields)
+        for k, field in enumerate(self.fields):
+            offset = self.table[base + 2 * k]
+            length = self.table[base + 2 * k + 1]
+            if length == NONE:
+                row[field] = None
+                continue
+            start = self.heap + offset
+            data = self.mmap[start:start + (length & ~JSON)]
+            row[field] = json.loads(data) if length & JSON \
+                else data.decode()
+        return row
+
+    def find(self, key: str, value) -> List[dict]:
+        """ Records whose key field equals value (key being one of the
+        hash indexed fields)
+        """
+        slots = self.keys[key]
+        if value is None or not len(slots):
+            return []
+        data = key_bytes(value)
+        flag = 0 if type(value) is str else JSON
+        field = self.fields.index(key)
+        mask = len(slots) - 1
+        slot = zlib.crc32(data) & mask
+        rows = []
+        while slots[slot]:
+            n = slots[slot] - 1
+            base = 2 * (n * len(self.fields) + field)
+            length = self.table[base + 1]
+            if length != NONE and length & JSON == flag:
+                start = self.heap + self.table[base]
+                if self.mmap[start:start + (length & ~JSON)] == data:
+                    rows.append(self.record(n))
+            slot = (slot + 1) & mask
+        return rows
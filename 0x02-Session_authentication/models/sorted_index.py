@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+""" Sorted index of the Base models
+"""
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from operator import itemgetter
+from typing import Iterator, List
+
+
+# entries per chunk: a chunk is split in two past twice this size
+CHUNK_SIZE = 512
+# number of changes past which an index is rebuilt by one sort rather
+# than changed entry by entry
+REBUILD_CHANGES = 128
+
+
+class SortedIndex():
+    """ Values in ascending order (equal values in insertion order) with
+    the ids of their objects, in chunks. An index is never changed once
+    built: changed() copies the chunks it touches into a new index, so
+    that readers keep walking the one they hold
+    """
+
+    __slots__ = ('maxes', 'keys', 'ids')
+
+    def __init__(self, pairs: List[tuple] = ()):
+        """ Initialize an index of the (value, id) pairs, sorted by value
+        """
+        self.keys = [[value for value, _ in pairs[n:n + CHUNK_SIZE]]
+                     for n in range(0, len(pairs), CHUNK_SIZE)]
+        self.ids = [[obj_id for _, obj_id in pairs[n:n + CHUNK_SIZE]]
+                    for n in range(0, len(pairs), CHUNK_SIZE)]
+        self.maxes = [keys[-1] for keys in self.keys]
+
+    def __len__(self) -> int:
+        """ Number of entries
+        """
+        return sum(len(ids) for ids in self.ids)
+
+    def pairs(self) -> List[tuple]:
+        """ (value, id) entries in order
+        """
+        return list(zip(chain.from_iterable(self.keys),
+                        chain.from_iterable(self.ids)))
+
+    def end(self) -> tuple:
+        """ Position past the last entry
+        """
+        return len(self.keys), 0
+
+    def lower(self, value) -> tuple:
+        """ (chunk, offset) position of the first entry not below value
+        """
+        n = bisect_left(self.maxes, value)
+        if n == len(self.maxes):
+            return self.end()
+        return n, bisect_left(self.keys[n], value)
+
+    def upper(self, value) -> tuple:
+        """ (chunk, offset) position of the first entry above value
+        """
+        n = bisect_right(self.maxes, value)
+        if n == len(self.maxes):
+            return self.end()
+        return n, bisect_right(self.keys[n], value)
+
+    def walk(self, lo: tuple, hi: tuple,
+             reverse: bool = False) -> Iterator[str]:
+        """ Ids of the entries from position lo (included) to hi
+        (excluded), in order or in reverse order
+        """
+        if lo >= hi:
+            return
+        chunks = range(hi[0] if hi[1] else hi[0] - 1, lo[0] - 1, -1) \
+            if reverse else range(lo[0], min(hi[0] + 1, len(self.ids)))
+        for n in chunks:
+            ids = self.ids[n]
+            start = lo[1] if n == lo[0] else 0
+            stop = hi[1] if n == hi[0] else len(ids)
+            if reverse:
+                yield from reversed(ids[start:stop])
+            else:
+                yield from ids[start:stop]
+
+    def changed(self, added: List[tuple],
+                removed: List[tuple]) -> 'SortedIndex':
+        """ New index with the added and without the removed (value, id)
+        entries
+        """
+        if len(added) + len(removed) > REBUILD_CHANGES:
+            removed_ids = {obj_id for _, obj_id in removed}
+            pairs = [pair for pair in self.pairs()
+                     if pair[1] not in removed_ids]
+            pairs.extend(added)
+            pairs.sort(key=itemgetter(0))
+            return SortedIndex(pairs)
+
+        index = SortedIndex()
+        index.maxes = self.maxes[:]
+        index.keys = self.keys[:]
+        index.ids = self.ids[:]
+        for value, obj_id in removed:
+            index.discard(value, obj_id)
+        for value, obj_id in added:
+            index.insert(value, obj_id)
+        return index
+
+    def insert(self, value, obj_id: str):
+        """ Add an entry, after those of equal value (only on an index
+        not yet visible to readers, see changed)
+        """
+        if not self.keys:
+            self.maxes.append(value)
+            self.keys.append([value])
+            self.ids.append([obj_id])
+            return
+        n, offset = self.upper(value)
+        if n == len(self.keys):
+            n, offset = n - 1, len(self.keys[n - 1])
+        keys, ids = self.keys[n][:], self.ids[n][:]
+        keys.insert(offset, value)
+        ids.insert(offset, obj_id)
+        if len(keys) > 2 * CHUNK_SIZE:
+            self.maxes[n:n + 1] = [keys[CHUNK_SIZE - 1], keys[-1]]
+            self.keys[n:n + 1] = [keys[:CHUNK_SIZE], keys[CHUNK_SIZE:]]
+            self.ids[n:n + 1] = [ids[:CHUNK_SIZE], ids[CHUNK_SIZE:]]
+        else:
+            self.maxes[n] = keys[-1]
+            self.keys[n] = keys
+            self.ids[n] = ids
+
+    def discard(self, value, obj_id: str):
+        """ Remove an entry if present (only on an index not yet visible
+        to readers, see changed)
+        """
+        n, offset = self.lower(value)
+        while n < len(self.keys):
+            keys, ids = self.keys[n], self.ids[n]
+            while offset < len(keys) and keys[offset] == value:
+                if ids[offset] == obj_id:
+                    if len(keys) == 1:
+                        del self.maxes[n], self.keys[n], self.ids[n]
+                        return
+                    keys, ids = keys[:], ids[:]
+                    del keys[offset], ids[offset]
+                    self.maxes[n] = keys[-1]
+                    self.keys[n] = keys
+                    self.ids[n] = ids
+                    return
+                offset += 1
+            if offset < len(keys):
+                return
+            n, offset = n + 1, 0